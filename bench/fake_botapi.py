@@ -0,0 +1,138 @@
+from threading import Condition, Thread
+from urllib.parse import parse_qs, urlsplit
+import http.server
+import json
+import socketserver
+import time
+
+
+class FakeBotAPI:
+    """A local stand-in for the Telegram Bot API.
+
+    Serves getMe, getUpdates (long-polled), sendMessage, getFile and file downloads. Updates are made up with
+    push_message() and push_photo(), and every sendMessage is passed to `on_send(chat_id, text, received)`.
+    """
+
+    BOT = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+    def __init__(self, host='127.0.0.1', port=0, on_send=None):
+        self.on_send = on_send
+        self.updates = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.files = {}  # file_id -> size
+        self.cond = Condition()
+
+        api = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True  # Headers and body go out as separate writes on a kept-alive connection
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+                params = {key: values[-1] for key, values in parse_qs(body).items()}
+                params.update({key: values[-1] for key, values in parse_qs(urlsplit(self.path).query).items()})
+                method = urlsplit(self.path).path.rsplit('/', 1)[-1]
+                handler = getattr(api, "api_" + method, None)
+                if handler is None:
+                    self.reply({"ok": False, "error_code": 404, "description": "Not Found: method not found"})
+                else:
+                    self.reply({"ok": True, "result": handler(params)})
+
+            def do_GET(self):
+                if urlsplit(self.path).path.startswith("/file/"):
+                    self.send_file()
+                else:
+                    self.do_POST()
+
+            def reply(self, response):
+                body = json.dumps(response).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', len(body))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_file(self):
+                file_id = urlsplit(self.path).path.rsplit('/', 1)[-1].split('.')[0]
+                size = api.files.get(file_id)
+                if size is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', 0)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', size)
+                self.end_headers()
+                chunk = file_id.encode('ascii').ljust(64 * 1024, b'\xff')  # Distinct content per file
+                while size > 0:
+                    self.wfile.write(chunk[:size])
+                    size -= len(chunk)
+
+        class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.url = "http://{}:{}".format(host, self.port)
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def push(self, chat_id, username, **fields):
+        with self.cond:
+            message = {
+                "message_id": self.next_message_id,
+                "from": {"id": sum(username.encode('utf-8')), "is_bot": False, "first_name": username, "username": username},
+                "chat": {"id": chat_id, "type": "supergroup", "title": "bench {}".format(chat_id)},
+                "date": int(time.time()),
+            }
+            message.update(fields)
+            self.next_message_id += 1
+            self.updates.append({"update_id": self.next_update_id, "message": message})
+            self.next_update_id += 1
+            self.cond.notify_all()
+
+    def push_message(self, chat_id, username, text):
+        self.push(chat_id, username, text=text)
+
+    def push_photo(self, chat_id, username, caption, size):
+        file_id = "photo{}".format(len(self.files))
+        self.files[file_id] = size
+        self.push(chat_id, username, caption=caption,
+                  photo=[{"file_id": file_id, "file_unique_id": "u" + file_id, "width": 1280, "height": 720, "file_size": size}])
+
+    def api_getMe(self, params):
+        return self.BOT
+
+    def api_getUpdates(self, params):
+        offset = int(params.get('offset', 0))
+        timeout = min(float(params.get('timeout', 0)), 30)
+        with self.cond:
+            self.cond.wait_for(lambda: self.updates and self.updates[-1]['update_id'] >= offset, timeout)
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            return list(self.updates)
+
+    def api_sendMessage(self, params):
+        received = time.time()
+        if self.on_send is not None:
+            self.on_send(int(params['chat_id']), params.get('text', ''), received)
+        with self.cond:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+        return {"message_id": message_id, "from": self.BOT, "date": int(received), "text": params.get('text', ''),
+                "chat": {"id": int(params['chat_id']), "type": "supergroup"}}
+
+    def api_getFile(self, params):
+        file_id = params['file_id']
+        return {"file_id": file_id, "file_size": self.files.get(file_id, 0), "file_path": "photos/{}.jpg".format(file_id)}
@@ -0,0 +1,100 @@
+from threading import Condition, Thread
+import socketserver
+import time
+
+
+class FakeIRCServer:
+    """Just enough of an IRC server to bridge against.
+
+    Clients are welcomed as soon as they register, may join any channel, and everything they PRIVMSG is passed to
+    `on_privmsg(channel, text, received)`. Traffic from other users is made up with say(), join() and quit().
+    """
+
+    NAME = "fake.irc"
+
+    def __init__(self, host='127.0.0.1', port=0, on_privmsg=None):
+        self.on_privmsg = on_privmsg
+        self.clients = []
+        self.joined = set()
+        self.cond = Condition()
+
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                self.nick = None
+                with server.cond:
+                    server.clients.append(self)
+                try:
+                    for raw in self.rfile:
+                        server.handle_line(self, raw.decode('utf-8', 'replace').rstrip('\r\n'))
+                finally:
+                    with server.cond:
+                        server.clients.remove(self)
+
+            def send(self, line):
+                self.wfile.write((line + "\r\n").encode('utf-8'))
+
+        class Server(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.server = Server((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def handle_line(self, client, line):
+        received = time.time()
+        prefix, _, trailing = line.partition(" :")
+        words = prefix.split()
+        if not words:
+            return
+        command = words[0].upper()
+
+        if command == "NICK":
+            client.nick = words[1]
+        elif command == "USER":
+            client.send(":{} 001 {} :Welcome".format(self.NAME, client.nick))
+            client.send(":{} 005 {} PREFIX=(ov)@+ CHANTYPES=# :are supported".format(self.NAME, client.nick))
+            client.send(":{0} MODE {0} :+i".format(client.nick))
+        elif command == "PING":
+            client.send(":{} PONG {} :{}".format(self.NAME, self.NAME, trailing or words[-1]))
+        elif command == "JOIN":
+            for channel in words[1].split(","):
+                client.send(":{0}!bot@localhost JOIN {1}".format(client.nick, channel))
+                client.send(":{} 353 {} = {} :{}".format(self.NAME, client.nick, channel, client.nick))
+                client.send(":{} 366 {} {} :End of /NAMES list.".format(self.NAME, client.nick, channel))
+                with self.cond:
+                    self.joined.add(channel)
+                    self.cond.notify_all()
+        elif command == "PRIVMSG" and self.on_privmsg is not None:
+            self.on_privmsg(words[1], trailing, received)
+
+    def wait_joined(self, channels, timeout):
+        with self.cond:
+            return self.cond.wait_for(lambda: set(channels) <= self.joined, timeout)
+
+    def broadcast(self, line):
+        with self.cond:
+            clients = list(self.clients)
+        for client in clients:
+            try:
+                client.send(line)
+            except OSError:
+                pass
+
+    def say(self, channel, nick, text):
+        self.broadcast(":{0}!{0}@users.fake PRIVMSG {1} :{2}".format(nick, channel, text))
+
+    def join(self, channel, nick):
+        self.broadcast(":{0}!{0}@users.fake JOIN {1}".format(nick, channel))
+
+    def quit(self, nick, reason):
+        self.broadcast(":{0}!{0}@users.fake QUIT :{1}".format(nick, reason))
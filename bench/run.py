@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""Offline load test for relaygram.
+
+Starts a fake IRC server and a fake Bot API on localhost, runs relaygram.py against them in a child process, and
+drives traffic both ways at a fixed rate. Each generated message carries a "bench-<n>" tag, so the time it left the
+generator can be matched with the time the other side received it. Reports throughput, p50/p99 relay latency,
+losses, and the bridge's CPU use and peak RSS (read from /proc, so Linux only).
+
+    python bench/run.py --duration 30 --irc-rate 20 --tg-rate 20 --channels 4 --media-ratio 0.1 --storm-size 200
+"""
+
+from argparse import ArgumentParser
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+from fake_botapi import FakeBotAPI
+from fake_irc import FakeIRCServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TAG_RE = re.compile(r'bench-(\d+)')
+
+
+class Tracker:
+    """Matches tagged messages that were sent with the ones that arrived, per direction."""
+
+    def __init__(self):
+        self.sent = {}  # tag -> (direction, when)
+        self.latencies = {"irc_to_telegram": [], "telegram_to_irc": []}
+        self.other = 0  # Deliveries without a tag, e.g. join/part summaries
+
+    def send(self, tag, direction):
+        self.sent[tag] = (direction, time.time())
+
+    def received(self, text, when):
+        tags = TAG_RE.findall(text)
+        if not tags:
+            self.other += 1
+        for tag in tags:
+            direction, sent = self.sent.pop(int(tag), (None, None))
+            if direction is not None:
+                self.latencies[direction].append(when - sent)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def proc_usage(pid):
+    """CPU seconds used and peak RSS in MiB of a process."""
+    with open("/proc/{}/stat".format(pid)) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')  # utime + stime
+    peak_rss = 0
+    with open("/proc/{}/status".format(pid)) as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                peak_rss = int(line.split()[1]) / 1024
+    return cpu, peak_rss
+
+
+def write_config(config_dir, args, irc_port, api_url):
+    channels = ["#bench{}".format(i) for i in range(args.channels)]
+    chat_ids = [-1000000000 - i for i in range(args.channels)]
+    media_port = free_port()
+
+    throttle = {} if not args.unthrottled else {'rate_global': 10000, 'rate_per_chat': 600000, 'burst_per_chat': 1000}
+    config = {
+        'relaygram': {'bot_token': "123:bench", 'engine': args.engine},
+        'journal': {'enabled': not args.no_journal, 'fsync': not args.no_fsync},
+        'media': {'port': media_port, 'base_url': "http://127.0.0.1:{}/".format(media_port)},
+        'telegram': dict({
+            'api_url': api_url, 'send_topic': True, 'send_part': True, 'send_join': True, 'convert_mentions': True,
+            'message_pattern': "<{nick}> {msg}", 'action_pattern': "* {nick} {msg}",
+            'kick_pattern': "** {kicker} has been kicked by {nick}: {msg}", 'join_pattern': "** {nick} has joined",
+            'part_pattern': "** {nick} has left", 'topic_pattern': "** Topic has been changed to {msg} by {src}",
+            'reply_prefix': "{nick}: ", 'message_age': 300, 'poll_timeout': 5,
+        }, **throttle),
+        'irc': {
+            'message_pattern': "<{nick}> {msg}", 'action_pattern': "* {nick} {msg}",
+            'kick_pattern': "** {kicker} has been kicked by {nick}", 'join_pattern': "** {nick} has joined",
+            'part_pattern': "** {nick} has left", 'topic_pattern': "** Topic has been changed to {msg} by {src}",
+            'shards': args.shards,
+            'servers': {
+                "Bench": dict({'hostname': "127.0.0.1", 'port': irc_port, 'nickname': "TGBot", 'channels': channels},
+                              **({'flood_rate': 10000, 'flood_burst': 1000} if args.unthrottled else {})),
+            },
+        },
+    }
+    with open(os.path.join(config_dir, "relaygram.yaml"), 'w') as f:
+        yaml.safe_dump(config, f)
+
+    channel_map = {
+        'tg': {str(chat_id): "127.0.0.1:{}".format(channel) for chat_id, channel in zip(chat_ids, channels)},
+        'irc': {"127.0.0.1:{}".format(channel): str(chat_id) for chat_id, channel in zip(chat_ids, channels)},
+    }
+    with open(os.path.join(config_dir, "channel_map.json"), 'w') as f:
+        json.dump(channel_map, f)
+    return channels, chat_ids
+
+
+def drive(args, irc, api, tracker, channels, chat_ids):
+    rng = random.Random(args.seed)
+    total_rate = args.irc_rate + args.tg_rate
+    if not total_rate:
+        return
+    interval = 1.0 / total_rate
+    tag = 0
+    next_storm = time.monotonic() + args.storm_interval
+    start = next_send = time.monotonic()
+    while time.monotonic() - start < args.duration:
+        index = tag % len(channels)
+        if rng.random() < args.irc_rate / total_rate:
+            tracker.send(tag, "irc_to_telegram")
+            irc.say(channels[index], "ircuser{}".format(rng.randrange(50)), "hello bench-{}".format(tag))
+        else:
+            tracker.send(tag, "telegram_to_irc")
+            user = "tguser{}".format(rng.randrange(50))
+            if rng.random() < args.media_ratio:
+                api.push_photo(chat_ids[index], user, "bench-{}".format(tag), args.media_kb * 1024)
+            else:
+                api.push_message(chat_ids[index], user, "hello bench-{}".format(tag))
+        tag += 1
+
+        if args.storm_size and time.monotonic() >= next_storm:
+            # A netsplit: a crowd leaves at once and comes back a moment later
+            nicks = ["splitter{}".format(i) for i in range(args.storm_size)]
+            for nick in nicks:
+                irc.quit(nick, "hub.fake.irc leaf.fake.irc")
+            for nick in nicks:
+                irc.join(channels[rng.randrange(len(channels))], nick)
+            next_storm += args.storm_interval
+
+        next_send += interval
+        time.sleep(max(0, next_send - time.monotonic()))
+
+
+def main():
+    parser = ArgumentParser(description="Offline relaygram load test")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of load (default 30)")
+    parser.add_argument("--irc-rate", type=float, default=10, help="IRC messages per second, over all channels")
+    parser.add_argument("--tg-rate", type=float, default=10, help="Telegram messages per second, over all chats")
+    parser.add_argument("--channels", type=int, default=4, help="Bridged channel/chat pairs")
+    parser.add_argument("--media-ratio", type=float, default=0.0, help="Fraction of Telegram messages that are photos")
+    parser.add_argument("--media-kb", type=int, default=256, help="Size of each photo")
+    parser.add_argument("--storm-size", type=int, default=0, help="Nicks in each netsplit storm (0 for none)")
+    parser.add_argument("--storm-interval", type=float, default=10, help="Seconds between storms")
+    parser.add_argument("--shards", type=int, default=1, help="irc.shards for the bridge")
+    parser.add_argument("--engine", default="threads", choices=("threads", "asyncio"), help="relaygram.engine for the bridge")
+    parser.add_argument("--unthrottled", action="store_true", help="Lift flood control and Telegram rate limits")
+    parser.add_argument("--no-journal", action="store_true", help="Run without the journal")
+    parser.add_argument("--no-fsync", action="store_true", help="Journal without fsync")
+    parser.add_argument("--drain", type=float, default=30, help="Seconds to wait for stragglers after the load stops")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    parser.add_argument("-v", dest="verbose", action="store_true", help="Show the bridge's own output")
+    args = parser.parse_args()
+
+    tracker = Tracker()
+    irc = FakeIRCServer(on_privmsg=lambda channel, text, when: tracker.received(text, when)).start()
+    api = FakeBotAPI(on_send=lambda chat_id, text, when: tracker.received(text, when)).start()
+
+    config_dir = tempfile.mkdtemp(prefix="relaygram-bench-")
+    bridge = None
+    try:
+        channels, chat_ids = write_config(config_dir, args, irc.port, api.url)
+        output = None if args.verbose else subprocess.DEVNULL
+        bridge = subprocess.Popen([sys.executable, os.path.join(ROOT, "relaygram.py"), "-c", config_dir] +
+                                  (["-v"] if args.verbose else []), cwd=ROOT, stdout=output, stderr=output)
+        if not irc.wait_joined(channels, 30):
+            raise SystemExit("The bridge never joined its channels")
+        time.sleep(1)  # Let the first getUpdates poll settle
+
+        cpu_before, _ = proc_usage(bridge.pid)
+        started = time.time()
+        drive(args, irc, api, tracker, channels, chat_ids)
+        deadline = time.time() + args.drain
+        while tracker.sent and time.time() < deadline:
+            time.sleep(.1)
+        elapsed = time.time() - started
+        cpu_after, peak_rss = proc_usage(bridge.pid)
+    finally:
+        if bridge is not None:
+            bridge.terminate()
+            bridge.wait()
+        irc.stop()
+        api.stop()
+        shutil.rmtree(config_dir, ignore_errors=True)
+
+    report = {'elapsed': elapsed, 'cpu_percent': 100 * (cpu_after - cpu_before) / elapsed, 'peak_rss_mb': peak_rss,
+              'other_deliveries': tracker.other}
+    lost = {}
+    for direction, _ in tracker.sent.values():
+        lost[direction] = lost.get(direction, 0) + 1
+    for direction, latencies in tracker.latencies.items():
+        report[direction] = {
+            'delivered': len(latencies),
+            'lost': lost.get(direction, 0),
+            'throughput': len(latencies) / elapsed,
+            'p50_ms': 1000 * percentile(latencies, .5),
+            'p99_ms': 1000 * percentile(latencies, .99),
+        }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for direction in tracker.latencies:
+        stats = report[direction]
+        print("{:16} {delivered:6} delivered {lost:5} lost {throughput:8.1f}/s  p50 {p50_ms:8.1f}ms  p99 {p99_ms:8.1f}ms"
+              .format(direction, **stats))
+    print("summaries/other  {}".format(tracker.other))
+    print("cpu {:.1f}%  peak rss {:.1f} MiB  over {:.1f}s".format(report['cpu_percent'], peak_rss, elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,48 @@
 #!/usr/bin/env python3
 
+import asyncio
 import os.path
 from argparse import ArgumentParser
-from queue import Queue
-from time import sleep
+from contextlib import contextmanager
+from time import sleep, time
+import signal
 import yaml
 import logging
 
-from relaygram.irc import IRCHandler
+from relaygram.irc_shards import IRCShards
 from relaygram.telegram import TelegramHandler
 from relaygram.http_server import HTTPHandler
 from relaygram.channel_map import ChannelMap
+from relaygram.media_store import MediaStore
+from relaygram.journal import Journal
+from relaygram.coalesce import Coalescer
+from relaygram.queues import DropPolicy, LoopQueue, RelayQueue
+from relaygram.aio import AsyncEngine
+from relaygram.reload import ConfigReloader
+from relaygram.botapi import BotAPITransport
+from relaygram.recorder import Recorder
+from relaygram.replay import Replayer
+from relaygram.profiler import SamplingProfiler
 
 
 class ConfigError(Exception):
     pass
 
 
+@contextmanager
+def timed(log, component):
+    # Startup is logged per component, so a slow one is easy to spot
+    started = time()
+    yield
+    log.info("{} set up in {:.2f}s".format(component, time() - started))
+
+
 class RelaygramBot:
-    def __init__(self, verbosity, config_dir):
+    def __init__(self, verbosity, config_dir, record=None, replay=None, speed=1.0, profile=None):
         self.log = logging.getLogger("relaygram")
         self.verbosity = verbosity
         self.config_dir = config_dir
-        self.config = yaml.load(open(os.path.join(config_dir, "relaygram.yaml"), "r"))
+        self.config = yaml.safe_load(open(os.path.join(config_dir, "relaygram.yaml"), "r"))
         self.config['config_dir'] = config_dir
         self.config['media_dir'] = os.path.join(config_dir, "media")
         if not os.path.exists(self.config['media_dir']):
@@ -37,36 +57,133 @@ class RelaygramBot:
 
         logging.getLogger("requests").setLevel(logging.WARNING)  # Quiet requests, too verbose at INFO
 
-        try:
-            self.channel_map = ChannelMap(os.path.join(config_dir, "channel_map.json"))
-        except FileNotFoundError:
-            self.channel_map = {}
-
-        self.irc_queue = Queue()
-        self.tg_queue = Queue()
-
-        self.irc = IRCHandler(self.channel_map, self.config, self.irc_queue, [self.tg_queue])
-        self.telegram = TelegramHandler(self.channel_map, self.config, self.tg_queue, [self.irc_queue])
-
-        self.irc.run()
-        self.telegram.run()
-
-        # Media Hoster
-        if self.config['media']['port'] and self.config['media']['port'] is not 0:
-            self.httpd = HTTPHandler(self.config)
-            self.httpd.run()
-
-        while True:
-            sleep(.1)
+        # Inbound traffic can be recorded, and a recording replayed against stand-ins for both networks
+        self.recorder = Recorder(record) if record else None
+        self.replayer = Replayer(replay, self.config, speed, self.replay_finished) if replay else None
+        self.profile = profile
+        self.profiler = None
+
+        started = time()
+        with timed(self.log, "Channel map"):
+            try:
+                self.channel_map = ChannelMap(os.path.join(config_dir, "channel_map.json"))
+            except FileNotFoundError:
+                self.channel_map = {}
+
+        with timed(self.log, "Media store"):
+            self.media_store = MediaStore(self.config)
+
+        # The asyncio engine runs the handlers on one event loop instead of a thread each
+        # Events waiting for Telegram are bounded, past queue_size they are dropped by drop_policy
+        tg_policy = DropPolicy("telegram", "telegram", self.config['telegram'].get('queue_size', 1000),
+                               self.config['telegram'].get('drop_policy'))
+        self.engine = self.config['relaygram'].get('engine', 'threads')
+        if self.engine == 'asyncio':
+            self.loop = asyncio.new_event_loop()
+            self.tg_queue = LoopQueue(self.loop, tg_policy)
+        elif self.engine == 'threads':
+            self.tg_queue = RelayQueue(tg_policy)
+        else:
+            raise ConfigError("Unknown engine {}, expected threads or asyncio".format(self.engine))
+
+        # Events go through the journal on their way to the other side, unless it has been turned off
+        journal_config = self.config.get('journal', {})
+        if journal_config.get('enabled', True):
+            with timed(self.log, "Journal"):
+                self.journal = Journal(os.path.join(config_dir, "journal.bin"), fsync=journal_config.get('fsync', True),
+                                       compact_bytes=journal_config.get('compact_mb', 4) * 1024 * 1024)
+            to_telegram = self.journal.destination("tg", self.tg_queue)
+        else:
+            self.journal = None
+            to_telegram = self.tg_queue
+
+        # Fold IRC join/part storms and netsplits into summaries before they reach Telegram
+        coalesce_window = self.config['telegram'].get('coalesce_window', 2)
+        if coalesce_window:
+            to_telegram = Coalescer(to_telegram, coalesce_window, self.config['telegram'].get('coalesce_threshold', 3))
+
+        # The IRC side is its own queue, it hands each event to the reactor threads running its destinations.
+        # Connections to the servers and to Telegram are opened in the background, each pair of a chat and a channel
+        # starts relaying once both are up, and they log how long that took.
+        with timed(self.log, "IRC"):
+            self.irc = IRCShards(self.channel_map, self.config, [to_telegram], self.journal,
+                                 self.config['irc'].get('shards', 1), self.media_store,
+                                 self.replayer.open_socket if self.replayer is not None else None)
+            if self.recorder is not None:
+                for handler in self.irc.handlers:
+                    handler.irc.add_global_handler("all_raw_messages", self.recorder.irc_line)
+        to_irc = self.journal.destination("irc", self.irc) if self.journal is not None else self.irc
+
+        with timed(self.log, "Telegram"):
+            transport = self.replayer.transport if self.replayer is not None else BotAPITransport(self.config, self.recorder)
+            self.telegram = TelegramHandler(self.channel_map, self.config, self.tg_queue, [to_irc], self.media_store,
+                                            self.journal, transport)
+        tg_policy.on_drop = self.telegram.ack  # Dropped is as done as delivered, the journal can forget it
+
+        # SIGHUP, or an edit when watching, applies relaygram.yaml and channel_map.json without reconnecting
+        self.reloader = ConfigReloader(config_dir, self.config, self.channel_map, self.irc,
+                                       self.config['relaygram'].get('reload_interval', 0))
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.reloader.request())
+        if self.recorder is not None:
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(signum, self.stop_recording)
+
+        if self.journal is not None:
+            self.journal.run()
+        self.media_store.run()
+        self.reloader.run()
+
+        # Media Hoster, a replay has no one to serve
+        if self.config['media']['port'] and self.config['media']['port'] is not 0 and self.replayer is None:
+            with timed(self.log, "Media server"):
+                self.httpd = HTTPHandler(self.config, self.media_store.retention)
+                self.httpd.run()
+        self.log.info("Started in {:.2f}s".format(time() - started))
+
+        if self.replayer is not None:
+            if self.profile:
+                self.profiler = SamplingProfiler().run()
+            self.replayer.start()
+
+        if self.engine == 'asyncio':
+            AsyncEngine(self.loop, self.irc.handlers, self.telegram, self.tg_queue).run_forever()
+        else:
+            self.irc.run()
+            self.telegram.run()
+            while True:
+                sleep(.1)
+
+    def stop_recording(self, signum, frame):
+        # Finish the recording, then stop the way the signal would have without us
+        self.recorder.close()
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+
+    def replay_finished(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler.write(self.profile)
+        logging.shutdown()
+        os._exit(0)  # The handler threads never return on their own, and a replay leaves nothing worth waiting for
 
 if __name__ == '__main__':
     parser = ArgumentParser(description="Relay chat between IRC and Telegram", epilog="https://github.com/Surye/relaygram")
     parser.add_argument("-c", dest="config_dir", default=os.path.expanduser("~/.relaygram"), help="Configuration Directory (default is ~/.relaygram)")
     parser.add_argument("-v", dest="verbosity", action='count', help="Verbosity Level (repeat for more verbose logging)")
 
+    parser.add_argument("--record", metavar="FILE", help="Record inbound IRC and Telegram traffic to FILE, for --replay")
+    parser.add_argument("--replay", metavar="FILE", help="Replay a recording against local stand-ins for IRC and Telegram, then exit. Use a copy of the config directory the recording was made with")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay this many times faster than recorded (default 1)")
+    parser.add_argument("--profile", metavar="FILE", help="Sample where time goes during --replay, and write per-function stats to FILE")
+
     args = parser.parse_args()
+    if args.record and args.replay:
+        parser.error("--record and --replay can't be used together")
+    if args.profile and not args.replay:
+        parser.error("--profile needs --replay")
 
     if not os.path.exists(args.config_dir):
         parser.error("Config directory {} does not exist. Please create it and copy relaygram.example.yaml to it as relaygram.yaml.".format(args.config_dir))
 
-    bot = RelaygramBot(args.verbosity, args.config_dir)
+    bot = RelaygramBot(args.verbosity, args.config_dir, args.record, args.replay, args.speed, args.profile)
@@ -0,0 +1,154 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import logging
+
+import twx.botapi
+from irc import schedule as irc_schedule
+
+
+class AsyncEngine:
+    """Runs the IRC reactors and the Telegram poll and send loops as one asyncio event loop.
+
+    This replaces the handler threads and their blocking waits. IRC sockets and the IRC queues are watched with
+    add_reader and the reactors' scheduled commands become loop timers, through the hooks irc.Reactor provides for
+    external main loops. Flood-controlled sends are pumped on timers too. Nothing wakes up unless there is data, a
+    due timer, or a queued event.
+
+    Bot API calls still happen on twx's request threads, but their results come back as futures with a deadline, so
+    a stuck request times out instead of hanging its loop. The Telegram sender makes its calls one after another on
+    a worker thread, as the threaded engine does, and so does update handling, which may make blocking calls of its
+    own.
+
+    Media downloads stay on the MediaPipeline pool, and the media HTTP server keeps its own thread.
+    """
+
+    GRACE = 10  # Seconds on top of the long-poll timeout before a getUpdates call counts as lost
+
+    def __init__(self, loop, irc_handlers, telegram, tg_queue):
+        self.log = logging.getLogger("relaygram.aio")
+        self.loop = loop
+        self.irc_handlers = irc_handlers
+        self.telegram = telegram
+        self.tg_queue = tg_queue
+
+        self.sender_executor = ThreadPoolExecutor(max_workers=1)
+        self.update_executor = ThreadPoolExecutor(max_workers=1)  # Updates are handled one batch at a time, in order
+        self.readers = {}  # socket -> fd it was registered under, sockets lose their fd once closed
+        self.timers = {}  # (handler, purpose) -> TimerHandle
+
+    def run_forever(self):
+        asyncio.set_event_loop(self.loop)
+        for handler in self.irc_handlers:
+            self.attach_irc(handler)
+        self.loop.create_task(self.telegram_poll())
+        self.loop.create_task(self.telegram_send())
+        self.loop.run_forever()
+
+    # IRC
+
+    def attach_irc(self, handler):
+        reactor = handler.irc
+        # Reactor only takes these hooks in its constructor, and ours was built (and connected) by the handler
+        reactor._on_connect = lambda sock: self.add_socket(handler, sock)
+        reactor._on_disconnect = self.remove_socket
+        reactor._on_schedule = lambda delay: self.schedule(handler, "timeout", delay, self.irc_timeout)
+
+        for sock in reactor.sockets:
+            self.add_socket(handler, sock)
+        self.loop.add_reader(handler.control_queue, self.irc_control_ready, handler)
+        self.loop.add_reader(handler.my_queue, self.irc_queue_ready, handler)
+        self.irc_timeout(handler)
+
+    def add_socket(self, handler, sock):
+        self.readers[sock] = sock.fileno()
+        self.loop.add_reader(sock, self.irc_readable, handler, sock)
+
+    def remove_socket(self, sock):
+        fd = self.readers.pop(sock, None)
+        if fd is not None:
+            self.loop.remove_reader(fd)
+
+    def schedule(self, handler, purpose, delay, callback):
+        # One pending timer per handler and purpose, the earliest wins
+        when = self.loop.time() + max(0, delay)
+        timer = self.timers.get((handler, purpose))
+        if timer is not None and not timer.cancelled() and timer.when() <= when:
+            return
+        if timer is not None:
+            timer.cancel()
+        self.timers[(handler, purpose)] = self.loop.call_at(when, self.fire, handler, purpose, callback)
+
+    def fire(self, handler, purpose, callback):
+        del self.timers[(handler, purpose)]
+        callback(handler)
+
+    def irc_readable(self, handler, sock):
+        handler.irc.process_data([sock])
+        self.pump_irc(handler)
+
+    def irc_control_ready(self, handler):
+        handler.process_control()
+        self.pump_irc(handler)
+
+    def irc_queue_ready(self, handler):
+        handler.process_queue()
+        self.pump_irc(handler)
+
+    def irc_timeout(self, handler):
+        handler.irc.process_timeout()
+        with handler.irc.mutex:
+            if handler.irc.delayed_commands:
+                delay = (handler.irc.delayed_commands[0] - irc_schedule.now()).total_seconds()
+                self.schedule(handler, "timeout", delay, self.irc_timeout)
+        self.pump_irc(handler)
+
+    def pump_irc(self, handler):
+        delay = handler.pump_senders()
+        if delay is not None:
+            self.schedule(handler, "send", delay, self.pump_irc)
+
+    # Telegram
+
+    async def call(self, method, *args, deadline=None, **kwargs):
+        """Make a twx call and await its result, returns None if it failed outright or missed the deadline."""
+        future = self.loop.create_future()
+
+        def settle(result):
+            self.loop.call_soon_threadsafe(lambda: future.done() or future.set_result(result))
+
+        method(*args, on_success=settle, on_error=settle, **kwargs)
+        try:
+            return await asyncio.wait_for(future, deadline)
+        except asyncio.TimeoutError:
+            return None
+
+    async def telegram_poll(self):
+        telegram = self.telegram
+        await self.loop.run_in_executor(None, telegram.identify)  # Usually done already, it started with the bridge
+        await self.loop.run_in_executor(self.update_executor, telegram.media.resume)
+        offset = telegram.journal.offset if telegram.journal is not None else 0
+        poll_timeout = telegram.config['telegram'].get('poll_timeout', 30)
+        while True:
+            updates = await self.call(telegram.twx.get_updates, offset, timeout=poll_timeout,
+                                      deadline=poll_timeout + self.GRACE)
+            if updates is None or isinstance(updates, twx.botapi.Error):
+                self.log.error("Failed to fetch telegram updates: {}".format(updates and updates.description))
+                await asyncio.sleep(telegram.config['telegram'].get('poll_retry', 5))
+                continue
+            # Off the loop, handling an update can block: an unmapped chat is answered with a blocking send
+            offset = await self.loop.run_in_executor(self.update_executor, telegram.process_updates, updates, offset)
+
+    async def telegram_send(self):
+        queue = self.tg_queue.queue
+        send_delay = None
+        while True:
+            if not self.telegram.accepting():
+                await asyncio.sleep(send_delay or 0)  # Backed up, leave events to the bounded queue
+            else:
+                try:
+                    batch = [await asyncio.wait_for(queue.get(), send_delay)]
+                except asyncio.TimeoutError:
+                    batch = []
+                self.telegram.process_batch(batch + self.tg_queue.drain())
+            # The sender blocks on each sendMessage, and nothing else may touch it while it runs
+            send_delay = await self.loop.run_in_executor(self.sender_executor, self.telegram.sender.pump)
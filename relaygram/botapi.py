@@ -0,0 +1,146 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic
+import logging
+
+from requests.adapters import HTTPAdapter
+import requests
+from twx.botapi import botapi as twx_calls
+import twx.botapi
+
+from relaygram import metrics
+
+POOLS = {'getUpdates': 'poll', 'getFile': 'download'}  # Bot API method -> pool, everything else is a send
+MEDIA_KEYS = ('photo', 'audio', 'document', 'sticker', 'video', 'voice', 'animation', 'video_note')
+
+
+class BotAPITransport:
+    """Keep-alive HTTP connection pools for all Bot API traffic.
+
+    twx sends every call on a new Session, so each one pays for its own connection and TLS handshake. Once installed,
+    calls go through one long-lived Session per kind of traffic instead: the long poll, sends, and media lookups and
+    downloads. Each keeps up to its configured number of connections open, so sends reuse warm connections and a
+    long poll never holds one that a send is waiting for. Every call is timed into the debug log and
+    relaygram_botapi_seconds, and calls slower than `slow_call` seconds are logged as warnings.
+
+    twx drops the file_unique_id of media when it parses updates, so it is picked out of the raw updates here and
+    kept for the last MAX_UNIQUE_IDS files, for the media store to recognise repeats by.
+    """
+
+    GRACE = 10  # Seconds on top of the long-poll timeout before giving up on getUpdates
+    MAX_UNIQUE_IDS = 10000
+
+    def __init__(self, config, recorder=None):
+        self.log = logging.getLogger("relaygram.botapi")
+        self.recorder = recorder
+        self.unique_ids = OrderedDict()  # file_id -> file_unique_id, oldest first
+        self.lock = Lock()
+        telegram_config = config['telegram']
+        self.timeout = telegram_config.get('request_timeout', 30)
+        self.slow_call = telegram_config.get('slow_call', 5)
+        self.sessions = {
+            'poll': self.session(telegram_config.get('pool_poll', 1)),
+            'send': self.session(telegram_config.get('pool_send', 4)),
+            'download': self.session(telegram_config.get('pool_download', config['media'].get('download_workers', 4))),
+        }
+
+    @staticmethod
+    def session(size):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def install(self):
+        """Send the calls of every twx TelegramBot through these pools."""
+        PooledRPCRequest.transport = self
+        # The API functions look the request class up in their own module, twx.botapi only re-exports it
+        twx_calls.TelegramBotRPCRequest = twx.botapi.TelegramBotRPCRequest = PooledRPCRequest
+
+    @contextmanager
+    def timed(self, method):
+        started = monotonic()
+        try:
+            yield
+        finally:
+            elapsed = monotonic() - started
+            metrics.BOTAPI_LATENCY.observe(elapsed, method=method)
+            if method != 'getUpdates' and elapsed > self.slow_call:  # A long poll is meant to take its time
+                self.log.warning("{} took {:.0f}ms".format(method, elapsed * 1000))
+            else:
+                self.log.debug("{} took {:.0f}ms".format(method, elapsed * 1000))
+
+    def send(self, method, request, poll_timeout=None):
+        """Send a prepared request on the method's pool, returns the response."""
+        session = self.sessions[POOLS.get(method, 'send')]
+        timeout = poll_timeout + self.GRACE if poll_timeout else self.timeout
+        settings = session.merge_environment_settings(request.url, {}, None, None, None)  # Proxies from the env
+        with self.timed(method):
+            return session.send(request, timeout=timeout, **settings)
+
+    def received(self, method, result):
+        # The raw updates, before twx parses them, are what a replay needs
+        if method != 'getUpdates':
+            return
+        if self.recorder is not None:
+            self.recorder.tg_updates(result)
+        for update in result:
+            for message in update.values():
+                if isinstance(message, dict):
+                    self.remember_unique_ids(message)
+
+    def remember_unique_ids(self, message):
+        with self.lock:
+            for key in MEDIA_KEYS:
+                media = message.get(key)
+                for file in media if isinstance(media, list) else [media]:  # A photo comes in several sizes
+                    if isinstance(file, dict) and 'file_unique_id' in file:
+                        self.unique_ids[file['file_id']] = file['file_unique_id']
+                        self.unique_ids.move_to_end(file['file_id'])
+            while len(self.unique_ids) > self.MAX_UNIQUE_IDS:
+                self.unique_ids.popitem(last=False)
+
+    def unique_id(self, file_id):
+        """The file_unique_id of a file seen in an update, or None."""
+        with self.lock:
+            return self.unique_ids.get(file_id)
+
+    def download(self, url, timeout):
+        """Start streaming a file on the download pool, the caller closes the response. Timed up to the headers."""
+        with self.timed('download'):
+            return self.sessions['download'].get(url, stream=True, timeout=timeout)
+
+
+class PooledRPCRequest(twx.botapi.TelegramBotRPCRequest):
+    """twx's request, sent through the transport's pools rather than a Session of its own."""
+
+    transport = None
+
+    def _async_call(self):
+        self.error = None
+        self.response = None
+
+        try:
+            resp = self.transport.send(self.api_method, self._get_request(), (self.params or {}).get('timeout'))
+        except requests.RequestException as e:
+            self.transport.log.warning("{} failed: {}".format(self.api_method, e))
+            if self.on_error is not None:
+                self.on_error(None)  # There is no Error for this, but whoever waits on us should know now
+            return
+
+        try:
+            api_response = resp.json()  # Telegram explains failures in the body too, like how long to back off
+        except ValueError:
+            api_response = {'ok': False, 'description': "Invalid JSON in response", 'error_code': resp.status_code}
+
+        if api_response.get('ok'):
+            self.transport.received(self.api_method, api_response['result'])
+            self.result = api_response['result'] if self.on_result is None else self.on_result(api_response['result'])
+            if self.on_success is not None:
+                self.on_success(self.result)
+        else:
+            self.error = twx.botapi.Error.from_result(api_response)
+            if self.on_error is not None:
+                self.on_error(self.error)
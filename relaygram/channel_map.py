@@ -1,37 +1,101 @@
+from threading import Lock, Timer
 import json
+import os
 
 
 class ChannelMap:
-    def __init__(self, filename):
+    """Routing table between Telegram chats and IRC channels.
+
+    Routes are keyed by an event's `src` exactly as the handlers build it, ("tg", chat_id) or (server, channel), so
+    finding where an event goes is a single dict lookup. A source may be bridged to any number of destinations.
+
+    The file keeps its original layout, {"tg": {chat_id: "server:channel"}, "irc": {"server:channel": chat_id}}, with
+    lists allowed wherever a single destination used to be. Changes are written behind, batched over `save_delay`
+    seconds, to a temporary file that is then renamed over the real one.
+    """
+
+    def __init__(self, filename, save_delay=1.0):
         self.filename = filename
-        self.mapping = {
-            'tg': {},
-            'irc': {},
-        }
+        self.save_delay = save_delay
+        self.routes = {}  # src -> tuple of destinations
+        self.lock = Lock()
+        self.save_timer = None
 
         self.reload()  # Seed data
 
+    @staticmethod
+    def parse_irc(key):
+        server, channel = key.split(":", 1)
+        return server, channel
+
+    @staticmethod
+    def listify(value):
+        return value if isinstance(value, list) else [value]
+
     def reload(self):
-        try:
-            self.mapping = json.load(open(self.filename, 'r'))
-        except FileNotFoundError:
-            pass  # Just use our empty mapping
+        """Read the file again. Changes still waiting to be written go to the file first, or they would be lost."""
+        with self.lock:
+            if self.save_timer is not None:
+                self.save_timer.cancel()
+                self.save_timer = None
+                self.write()
 
-    def save(self):
-        try:
-            json.dump(self.mapping, open(self.filename, 'w'))
-        except FileNotFoundError:
-            pass  # Just use our empty mapping
-
-    def get_dest(self, protocol, src):
-        try:
-            return self.mapping[protocol][str(src)]  # We store this in json, so all keys are strings
-        except KeyError:
-            return None
-
-    def set_mapping(self, tg_id, dest):
-        # TODO support more than IRC
-        self.mapping["tg"][str(tg_id)] = str(dest)
-        self.mapping["irc"][str(dest)] = str(tg_id)
+            try:
+                with open(self.filename, 'r') as f:
+                    mapping = json.load(f)
+            except FileNotFoundError:
+                mapping = {}  # Just use our empty mapping
+
+            routes = {}
+            for tg_id, dests in mapping.get('tg', {}).items():
+                routes[("tg", int(tg_id))] = tuple(self.parse_irc(dest) for dest in self.listify(dests))
+            for irc_key, dests in mapping.get('irc', {}).items():
+                routes[self.parse_irc(irc_key)] = tuple(int(tg_id) for tg_id in self.listify(dests))
+            self.routes = routes  # Swapped in whole, readers never see a half built table
+
+    def route(self, src):
+        """Destinations for an event coming from `src`: (server, channel) tuples for Telegram sources, chat ids for IRC."""
+        return self.routes.get(src, ())
+
+    def add_mapping(self, tg_id, server, channel):
+        with self.lock:
+            routes = dict(self.routes)
+            tg_src, irc_src = ("tg", int(tg_id)), (server, channel)
+            if irc_src not in routes.get(tg_src, ()):
+                routes[tg_src] = routes.get(tg_src, ()) + (irc_src,)
+            if int(tg_id) not in routes.get(irc_src, ()):
+                routes[irc_src] = routes.get(irc_src, ()) + (int(tg_id),)
+            self.routes = routes
         self.save()
 
+    def save(self):
+        # Write behind, so a burst of changes costs a single write
+        with self.lock:
+            if self.save_timer is None:
+                self.save_timer = Timer(self.save_delay, self.flush)
+                self.save_timer.daemon = True
+                self.save_timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.save_timer = None
+            self.write()
+
+    def write(self):
+        # Called with the lock held
+        mapping = {
+            'tg': {},
+            'irc': {},
+        }
+        for src, dests in self.routes.items():
+            if src[0] == "tg":
+                mapping['tg'][str(src[1])] = ["{}:{}".format(*dest) for dest in dests]
+            else:
+                mapping['irc']["{}:{}".format(*src)] = [str(dest) for dest in dests]
+
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, 'w') as f:
+            json.dump(mapping, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self.filename)
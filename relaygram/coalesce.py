@@ -0,0 +1,72 @@
+from threading import Lock, Timer
+from time import monotonic
+import re
+
+from relaygram import events
+
+# A netsplit QUIT reason is the two servers that lost each other, e.g. "hub.example.net leaf.example.net"
+NETSPLIT_RE = re.compile(r'^[\w-]+(\.[\w-]+)+ [\w-]+(\.[\w-]+)+$')
+
+
+class Coalescer:
+    """Sits in front of an outbound queue and folds join/part storms into one summary per channel.
+
+    Joins and parts are held for `window` seconds per source. If no more than `threshold` of them turn up they are
+    passed on unchanged, otherwise they are replaced by a single Summary event. Parts caused by a netsplit are always
+    summarised, as are the joins of nicks coming back from one within `rejoin_window` seconds. Everything else goes
+    straight through without waiting.
+    """
+
+    def __init__(self, out_queue, window=2.0, threshold=3, rejoin_window=600):
+        self.out_queue = out_queue
+        self.window = window
+        self.threshold = threshold
+        self.rejoin_window = rejoin_window
+
+        self.lock = Lock()
+        self.buckets = {}  # src -> list of held events
+        self.split_nicks = {}  # (server, nick) -> when they split
+
+    def put_nowait(self, item):
+        if item.type is not events.Join and item.type is not events.Part:
+            self.out_queue.put_nowait(item)
+            return
+
+        with self.lock:
+            bucket = self.buckets.get(item.src)
+            if bucket is None:
+                bucket = self.buckets[item.src] = []
+                timer = Timer(self.window, self.flush, args=(item.src,))
+                timer.daemon = True
+                timer.start()
+            bucket.append(item)
+
+    def flush(self, src):
+        with self.lock:
+            held = self.buckets.pop(src)
+
+            now = monotonic()
+            split = rejoined = joined = parted = 0
+            for item in held:
+                key = (src[0], item.user)
+                if item.type is events.Part and item.msg and NETSPLIT_RE.match(item.msg):
+                    split += 1
+                    self.split_nicks[key] = now
+                elif item.type is events.Join and now - self.split_nicks.get(key, now - self.rejoin_window) < self.rejoin_window:
+                    rejoined += 1
+                elif item.type is events.Join:
+                    joined += 1
+                else:
+                    parted += 1
+
+            for key in [key for key, when in self.split_nicks.items() if now - when >= self.rejoin_window]:
+                del self.split_nicks[key]
+
+        if not split and not rejoined and len(held) <= self.threshold:
+            for item in held:
+                self.out_queue.put_nowait(item)
+            return
+
+        counts = [(split, "split"), (rejoined, "rejoined from a netsplit"), (joined, "joined"), (parted, "left")]
+        summary = ", ".join("{} {} {}".format(count, "user" if count == 1 else "users", what) for count, what in counts if count)
+        self.out_queue.put_nowait(events.Summary(src=src, msg=summary)._replace(ts=held[0].ts))
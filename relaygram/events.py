@@ -1,6 +1,8 @@
 from collections import namedtuple
 
-_EventBase = namedtuple("Event", "type, src, user, msg")
+# seq is assigned by the journal when an event is recorded, it stays None for events that never were.
+# ts is the wall clock time the event arrived at the bridge, set by the handler that received it.
+_EventBase = namedtuple("Event", "type, src, user, msg, seq, ts", defaults=(None, None))
 
 
 class Message(_EventBase):
@@ -21,8 +23,9 @@ class Join(_EventBase):
 
 class Part(_EventBase):
     __slots__ = ()
-    def __new__(cls, src, user):
-        self = super(Part, cls).__new__(cls, cls, src=src, user=user, msg=None)
+
+    def __new__(cls, src, user, msg=None):
+        self = super(Part, cls).__new__(cls, cls, src=src, user=user, msg=msg)
         return self
 
 
@@ -49,3 +52,10 @@ class Action(_EventBase):
         self = super(Action, cls).__new__(cls, cls, src=src, user=user, msg=msg)
         return self
 
+
+class Summary(_EventBase):
+    __slots__ = ()
+
+    def __new__(cls, src, msg):
+        self = super(Summary, cls).__new__(cls, cls, src=src, user=None, msg=msg)
+        return self
@@ -1,14 +1,26 @@
 import http.server
+import socketserver
+from email.utils import formatdate, parsedate_to_datetime
 from threading import Thread
+from urllib.parse import urlsplit, unquote, parse_qs
 import os.path
 import mimetypes
+import re
+
+from relaygram import metrics
+from relaygram.transcode import PNG_SUFFIX, PREVIEW_SUFFIX
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True  # One thread per connection, so a slow client only holds up itself
+
 
 class HTTPHandler:
-    def __init__(self, config):
+    def __init__(self, config, retention=None):
         self.config = config
 
-        handler = HTTPHandler.make_http_handler(self.config['media_dir'])
-        self.httpd = http.server.HTTPServer(('', self.config['media']['port']), handler)
+        handler = HTTPHandler.make_http_handler(self.config['media_dir'], retention)
+        self.httpd = ThreadingHTTPServer(('', self.config['media']['port']), handler)
 
         self.thread = Thread(target=self.main_loop)
 
@@ -20,27 +32,144 @@ class HTTPHandler:
         self.httpd.serve_forever()
 
     @staticmethod
-    def make_http_handler(root_path):
+    def make_http_handler(root_path, retention=None):
+        root_path = os.path.abspath(root_path)
+        range_re = re.compile(r'^bytes=(\d*)-(\d*)$')
+
         class RelayGramHTTPHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Keep-alive
+
             def __init__(self, *args, **kwargs):
                 super(RelayGramHTTPHandler, self).__init__(*args, **kwargs)
 
+            def do_HEAD(self):
+                self.serve(send_body=False)
+
             def do_GET(self):
-                file_path = os.path.abspath(root_path + self.path)
+                self.serve(send_body=True)
 
-                if os.path.commonprefix([root_path, file_path]) != os.path.abspath(root_path):  # Detect path traversal attempt
-                    self.send_error(501, "Nice try")
+            def serve(self, send_body):
+                if urlsplit(self.path).path == '/metrics':
+                    self.serve_metrics(send_body)
                 else:
-                    if not os.path.exists(file_path) or not os.path.isfile(file_path):
+                    self.serve_file(send_body)
+
+            def serve_metrics(self, send_body):
+                body = metrics.REGISTRY.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', metrics.Registry.CONTENT_TYPE)
+                self.send_header('Content-Length', len(body))
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                if send_body:
+                    self.wfile.write(body)
+
+            def serve_file(self, send_body):
+                file_path = os.path.abspath(root_path + unquote(urlsplit(self.path).path))
+
+                if file_path != root_path and not file_path.startswith(root_path + os.sep):  # Detect path traversal attempt
+                    self.send_error(501, "Nice try")
+                    return
+
+                filename = os.path.relpath(file_path, root_path)
+                variant_path = self.choose_variant(file_path)
+                try:
+                    f = open(variant_path, mode='rb')
+                except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+                    if retention is not None and retention.is_evicted(filename):
+                        self.send_error(410, 'Media Expired')
+                    else:
                         self.send_error(404, 'File Not Found')
+                    return
+
+                with f:
+                    stat = os.fstat(f.fileno())
+                    # Media names are never reused for different content, so size and mtime make a stable validator
+                    etag = '"{:x}-{:x}"'.format(stat.st_size, int(stat.st_mtime))
+                    last_modified = formatdate(stat.st_mtime, usegmt=True)
+
+                    if self.not_modified(etag, stat.st_mtime):
+                        self.send_response(304)
+                        self.send_cache_headers(etag, last_modified)
+                        self.end_headers()
+                        return
+
+                    offset, length = 0, stat.st_size
+                    byte_range = self.headers.get('Range')
+                    if byte_range is not None and self.headers.get('If-Range', etag) in (etag, last_modified):
+                        match = range_re.match(byte_range.strip())
+                        start, end = match.groups() if match else ('', '')
+                        if not start and not end:
+                            byte_range = None  # Unsupported form (e.g. multiple ranges), serve the whole file
+                        else:
+                            if not start:
+                                offset = max(0, stat.st_size - int(end))  # Suffix range, the last N bytes
+                                last = stat.st_size - 1
+                            else:
+                                offset = int(start)
+                                last = min(int(end), stat.st_size - 1) if end else stat.st_size - 1
+                            if offset >= stat.st_size or last < offset:  # Includes bytes=-0 and an empty file
+                                self.send_response(416)
+                                self.send_header('Content-Range', 'bytes */{}'.format(stat.st_size))
+                                self.send_header('Content-Length', 0)
+                                self.end_headers()
+                                return
+                            length = last - offset + 1
                     else:
-                        mimetype = mimetypes.guess_type(file_path)
+                        byte_range = None
 
+                    if byte_range is not None:
+                        self.send_response(206)
+                        self.send_header('Content-Range', 'bytes {}-{}/{}'.format(offset, offset + length - 1, stat.st_size))
+                    else:
                         self.send_response(200)
-                        if mimetype[0]:
-                            self.send_header('Content-Type', mimetype[0])
-                        self.send_header('Content-Length', os.path.getsize(file_path))
-                        self.end_headers()
-                        self.wfile.write(open(file_path, mode='rb').read())
+
+                    mimetype = mimetypes.guess_type(variant_path)
+                    if mimetype[0]:
+                        charset = '; charset=utf-8' if mimetype[0].startswith('text/') else ''  # Offloaded pastes
+                        self.send_header('Content-Type', mimetype[0] + charset)
+                    self.send_header('Content-Length', length)
+                    self.send_header('Accept-Ranges', 'bytes')
+                    self.send_cache_headers(etag, last_modified)
+                    self.end_headers()
+
+                    if send_body and length:
+                        self.wfile.flush()
+                        self.connection.sendfile(f, offset, length)  # Zero-copy where the OS supports it
+                        if retention is not None:
+                            retention.touch(filename)  # The original too, it is evicted along with its variants
+                            if variant_path != file_path:
+                                retention.touch(os.path.relpath(variant_path, root_path))
+
+            def choose_variant(self, file_path):
+                # The transcoder may have left smaller or more widely viewable copies of an image beside it. A large
+                # image is served as its preview and webp as PNG to clients that don't take it, unless ?original is asked
+                if 'original' in parse_qs(urlsplit(self.path).query, keep_blank_values=True):
+                    return file_path
+                if os.path.exists(file_path + PREVIEW_SUFFIX):
+                    return file_path + PREVIEW_SUFFIX
+                if (file_path.lower().endswith('.webp') and 'image/webp' not in self.headers.get('Accept', '') and
+                        os.path.exists(file_path + PNG_SUFFIX)):
+                    return file_path + PNG_SUFFIX
+                return file_path
+
+            def not_modified(self, etag, mtime):
+                if_none_match = self.headers.get('If-None-Match')
+                if if_none_match is not None:
+                    return if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]
+
+                if_modified_since = self.headers.get('If-Modified-Since')
+                if if_modified_since is not None:
+                    try:
+                        return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+                    except (TypeError, ValueError):
+                        return False
+                return False
+
+            def send_cache_headers(self, etag, last_modified):
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', last_modified)
+                self.send_header('Cache-Control', 'public, max-age=31536000, immutable')
+                self.send_header('Vary', 'Accept')  # Which variant is served depends on it
 
         return RelayGramHTTPHandler
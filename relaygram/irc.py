@@ -1,20 +1,33 @@
+from functools import partial
 from threading import Thread
 from irc import client as irc
-from queue import Empty
-from time import sleep
+from irc import schedule as irc_schedule
+from time import time
+import select
+import socket
 import logging
-from relaygram import events
+from relaygram import events, metrics
+from relaygram.irc_sender import IRCSender, HIGH, LOW
+from relaygram.membership import Membership
+from relaygram.queues import SelectableQueue
+from relaygram.splitter import split_message
 
 
 class IRCHandler:
-    def __init__(self, channel_map, config, my_queue, out_queues):
+    def __init__(self, channel_map, config, my_queue, out_queues, journal=None, servers=None, media_store=None,
+                 open_socket=None):
         self.log = logging.getLogger("relaygram.irc")
         self.channel_map = channel_map
         self.config = config
         self.my_queue = my_queue
+        self.control_queue = SelectableQueue()  # Work from call_soon, never held back or dropped like events
         self.out_queues = out_queues
+        self.journal = journal
+        self.media_store = media_store
+        self.open_socket = open_socket or socket.create_connection  # Replays swap in their own servers
 
         self.initalized_servers = []
+        self.max_backlog = self.config['irc'].get('max_backlog', 1000)
 
         # Build up IRC connections
         self.irc = irc.Reactor()
@@ -27,34 +40,122 @@ class IRCHandler:
         self.irc.add_global_handler("part", handler=self.irc_part)
         self.irc.add_global_handler("quit", handler=self.irc_quit)
         self.irc.add_global_handler("kick", handler=self.irc_kick)
+        self.irc.add_global_handler("nick", handler=self.irc_nick)
 
         # System Events
         self.irc.add_global_handler("namreply", handler=self.irc_namreply)
+        self.irc.add_global_handler("endofnames", handler=self.irc_endofnames)
+        self.irc.add_global_handler("featurelist", handler=self.irc_featurelist)
         self.irc.add_global_handler("disconnect", handler=self.irc_disconnect)
         self.irc.add_global_handler("nicknameinuse", handler=self.irc_nicknameinuse)
         self.irc.add_global_handler("umode", handler=self.irc_umode)
 
         self.irc_servers = {}
-        self.irc_channels = {}
-        for server_name, server_params in self.config['irc']['servers'].items():
+        self.irc_senders = {}
+        self.irc_channels = {}  # server -> channels to join
+        self.members = {}  # server -> Membership
+        self.own_masks = {}  # server -> our nick!user@host, as others see it
+        self.nicknames = {}  # server -> configured nickname, ours until the connection has one
+        self.connect_started = {}  # server -> when we started connecting, for the startup timing
+        self.disconnected = set()  # Servers we lost or never reached, their lines are dropped until a restart
+        servers = self.config['irc']['servers'] if servers is None else servers  # A shard only runs some of them
+        for server_name, server_params in servers.items():
             self.initialize_server(server_params)
 
         self.thread = Thread(target=self.main_loop)
 
+    def call_soon(self, function, *args):
+        """Run a function on this handler's own thread between events, its connections aren't safe to use from others."""
+        self.control_queue.put_nowait(partial(function, *args))
+
     def initialize_server(self, server_params):
+        hostname = server_params['hostname']
         irc_server = self.irc.server()
-        irc_server.connect(server_params['hostname'], server_params['port'], server_params['nickname'])
-        self.irc_channels[irc_server.server] = {}
+        self.irc_channels[hostname] = list(server_params['channels'])
+        self.nicknames[hostname] = server_params['nickname']
+        self.members[hostname] = Membership()
+        for channel in server_params['channels']:
+            self.members[hostname].add_channel(channel)
+
+        self.irc_servers[hostname] = irc_server
+        sender = IRCSender(irc_server, server_params.get('flood_rate', 1.0), server_params.get('flood_burst', 4),
+                           self.max_backlog)
         for channel in server_params['channels']:
-            self.irc_channels[irc_server.server][channel] = set()
+            sender.hold(channel)  # Until we have joined it
+        self.irc_senders[hostname] = sender
+        metrics.QUEUE_DEPTH.set_function(sender.backlog, queue="irc:" + hostname)
 
-        self.irc_servers[server_params['hostname']] = irc_server
+        # Every server connects at the same time, one that is slow or down doesn't hold up the rest
+        self.connect_started[hostname] = time()
+        Thread(target=self.open_connection, args=(irc_server, server_params), daemon=True).start()
+
+    def open_connection(self, connection, server_params):
+        hostname, port = server_params['hostname'], server_params['port']
+        try:
+            sock = self.open_socket((hostname, port), self.config['irc'].get('connect_timeout', 30))
+            sock.settimeout(None)
+        except OSError as e:
+            self.log.error("Failed to connect to {}:{} after {:.2f}s: {}".format(
+                hostname, port, time() - self.connect_started[hostname], e))
+            self.call_soon(self.lost, connection)
+            return
+        self.log.info("Connected to {}:{} in {:.2f}s".format(hostname, port, time() - self.connect_started[hostname]))
+        self.call_soon(self.log_on, connection, server_params, sock)  # The reactor is only touched from our thread
+
+    def log_on(self, connection, server_params, sock):
+        if self.irc_servers.get(server_params['hostname']) is not connection:
+            sock.close()  # Removed by a reload while we were connecting
+            return
+        connection.connect(server_params['hostname'], server_params['port'], server_params['nickname'],
+                           connect_factory=lambda server_address: sock)
+
+    def add_server(self, server_params):
+        self.log.info("Connecting to new server {}".format(server_params['hostname']))
+        self.initialize_server(server_params)
+
+    def remove_server(self, server):
+        self.log.info("Leaving removed server {}".format(server))
+        connection = self.irc_servers.pop(server)
+        dropped = self.irc_senders.pop(server).discard()
+        if dropped:
+            self.log.warning("Dropped {} unsent lines for {}".format(dropped, server))
+        metrics.QUEUE_DEPTH.remove(queue="irc:" + server)
+        del self.irc_channels[server], self.members[server]
+        self.own_masks.pop(server, None)
+        self.nicknames.pop(server, None)
+        self.connect_started.pop(server, None)
+        self.disconnected.discard(server)
+        if connection in self.initalized_servers:
+            self.initalized_servers.remove(connection)
+        connection.disconnect("Bridge removed from this server")
+
+    def set_channels(self, server, channels):
+        """Join and part only the channels that differ from what the server runs now."""
+        connection = self.irc_servers[server]
+        membership = self.members[server]
+        old = {membership.fold(channel): channel for channel in self.irc_channels[server]}
+        new = {membership.fold(channel): channel for channel in channels}
+        for key in new.keys() - old.keys():
+            self.log.info("Joining {} on {}".format(new[key], server))
+            membership.add_channel(new[key])
+            self.irc_senders[server].hold(new[key])
+            if connection in self.initalized_servers:  # Otherwise the umode handler joins it with the rest
+                connection.join(new[key])
+        for key in old.keys() - new.keys():
+            self.log.info("Parting {} on {}".format(old[key], server))
+            membership.remove_channel(old[key])
+            self.irc_senders[server].release(old[key])
+            self.irc_senders[server].discard(old[key])
+            if connection.is_connected():
+                connection.part(old[key])
+        self.irc_channels[server] = list(channels)
 
     def irc_umode(self, connection, event):
         #  Set when server connection is finished, some servers don't like early join messages.
         if connection not in self.initalized_servers:
-            for channel in self.irc_channels[connection.server].keys():
+            for channel in self.irc_channels[connection.server]:
                 connection.join(channel)
+            self.irc.execute_delayed(self.config['irc'].get('join_timeout', 30), self.join_timeout, (connection.server,))
         self.initalized_servers.append(connection)
 
     def run(self):
@@ -62,20 +163,54 @@ class IRCHandler:
         return self
 
     def main_loop(self):
+        # Wait on the server sockets and the outbound queue together, so we only wake up for real work.
+        send_delay = None
         while True:
-            self.irc.process_once()
-            self.process_queue_once()
-            sleep(.1)
-
-    def process_queue_once(self):
-        try:
-            self.process_event(self.my_queue.get_nowait())
-        except Empty:
-            pass
+            queues = [self.control_queue, self.my_queue]
+            readable, _, _ = select.select(self.irc.sockets + queues, [], [], self.next_timeout(send_delay))
+            self.irc.process_data([sock for sock in readable if sock not in queues])
+            self.irc.process_timeout()
+            if self.control_queue in readable:
+                self.process_control()
+            if self.my_queue in readable:
+                self.process_queue()
+            send_delay = self.pump_senders()
+
+    def next_timeout(self, send_delay):
+        # Sleep until the reactor's next scheduled command or the next flood-controlled send, whichever is first
+        timeouts = [send_delay] if send_delay is not None else []
+        with self.irc.mutex:
+            if self.irc.delayed_commands:
+                timeouts.append(max(0, (self.irc.delayed_commands[0] - irc_schedule.now()).total_seconds()))
+        return min(timeouts) if timeouts else None
+
+    def pump_senders(self):
+        delays = [delay for delay in (sender.pump() for sender in self.irc_senders.values()) if delay is not None]
+        return min(delays) if delays else None
+
+    def process_control(self):
+        for function in self.control_queue.drain():
+            try:
+                function()
+            except Exception:
+                self.log.exception("Failed to run {}".format(function))
+
+    def process_queue(self):
+        for event in self.my_queue.drain():
+            try:
+                self.process_event(event)
+            except Exception:
+                self.log.exception("Failed to relay event to irc: {}".format(event))
+                metrics.EVENTS_DROPPED.inc(network="irc", reason="error")
+                self.ack(event)  # Don't replay it after a restart just to fail again
 
     def process_event(self, event):
-        src_id = event.src[1]
-        [server, channel] = self.channel_map.get_dest("tg", src_id).split(":")
+        dests = []
+        for server, channel in self.channel_map.route(event.src):
+            if server in self.disconnected:
+                metrics.EVENTS_DROPPED.inc(network="irc", reason="disconnected")
+            elif server in self.irc_senders:
+                dests.append((server, channel))
         irc_config = self.config['irc']
 
         if event.type is events.Message:
@@ -93,66 +228,153 @@ class IRCHandler:
         else:
             msg = None
 
-        if msg:
+        if msg and dests and event.type in (events.Message, events.Action) and self.is_paste(msg):
+            msg = self.offload_paste(event, msg)
+
+        if msg and dests:
             self.log.info("Sending to irc: {msg}".format(msg=msg))
-            for line in msg.splitlines():
-                if line.strip() != '':
-                    for msg in [line[i:i+400] for i in range(0, len(line), 400)]:
-                        self.irc_servers[server].privmsg(channel, msg)
-                        sleep(0.75)
+            unsent = [len(dests)]
+
+            def sent():
+                if event.ts is not None:
+                    metrics.RELAY_LATENCY.observe(max(0, time() - event.ts), direction="telegram_to_irc")
+                unsent[0] -= 1
+                if not unsent[0]:
+                    self.ack(event)
+
+            priority = LOW if event.type in (events.Join, events.Part) else HIGH
+            for server, channel in dests:
+                self.irc_senders[server].queue(channel, split_message(msg, self.line_budget(server, channel)), on_sent=sent,
+                                               priority=priority)
+        else:
+            self.ack(event)
+
+    def line_budget(self, server, channel):
+        # Lines are 512 bytes on the wire, less CRLF and the prefix the server puts in front when relaying ours
+        # Events can arrive before we have logged on, the connection only knows its nickname from then on
+        connection = self.irc_servers[server]
+        nickname = connection.get_nickname() if connection.is_connected() else self.nicknames[server]
+        mask = self.own_masks.get(server) or "{}!{}@{}".format(nickname, "u" * 10, "h" * 63)
+        return 512 - 2 - len(":{} PRIVMSG {} :".format(mask, channel).encode('utf-8'))
+
+    def is_paste(self, msg):
+        irc_config = self.config['irc']
+        max_lines, max_bytes = irc_config.get('paste_lines', 5), irc_config.get('paste_bytes', 2048)
+        lines = [line for line in msg.splitlines() if line.strip()]
+        return self.media_store is not None and ((max_lines and len(lines) > max_lines) or
+                                                 (max_bytes and len(msg.encode('utf-8')) > max_bytes))
+
+    def offload_paste(self, event, msg):
+        # Store the text with the media and send a link, rather than flooding the channel with it line by line
+        irc_config = self.config['irc']
+        try:
+            filename = self.media_store.add_data(event.msg.encode('utf-8'), ".txt")
+        except OSError:
+            self.log.exception("Failed to store paste, sending it as is")
+            return msg
+        lines = len([line for line in event.msg.splitlines() if line.strip()])
+        paste = irc_config.get('paste_pattern', "[paste] {url} ({lines} lines)").format(
+            url=self.config['media']['base_url'] + filename, lines=lines)
+        return irc_config['message_pattern'].format(nick=event.user, msg=paste)
+
+    def ack(self, event):
+        # Tell the journal this event has been delivered
+        if self.journal is not None and event.seq is not None:
+            self.journal.ack("irc", event.seq)
+
+    def relay(self, item):
+        item = item._replace(ts=time())  # Stamped on arrival, for the relay latency metric
+        [queue.put_nowait(item) for queue in self.out_queues]
 
     def irc_pubmsg(self, connection, event):
         item = events.Message(src=(connection.server, event.target), user=event.source.nick, msg=event.arguments[0])
-        [queue.put_nowait(item) for queue in self.out_queues]
+        self.relay(item)
 
     def irc_topic(self, connection, event):
         item = events.Topic(src=(connection.server, event.target), user=event.source.nick, msg=event.arguments[0])
-        [queue.put_nowait(item) for queue in self.out_queues]
+        self.relay(item)
 
     def irc_action(self, connection, event):
         item = events.Action(src=(connection.server, event.target), user=event.source.nick, msg=event.arguments[0])
-        [queue.put_nowait(item) for queue in self.out_queues]
+        self.relay(item)
 
     def irc_join(self, connection, event):
-        self.irc_channels[connection.server][event.target].add(event.source.nick)
+        if event.source.nick == connection.get_nickname():
+            self.own_masks[connection.server] = str(event.source)
+            self.joined(connection.server, event.target)
+        self.members[connection.server].join(event.target, event.source.nick)
 
         item = events.Join(src=(connection.server, event.target), user=event.source.nick)
-        [queue.put_nowait(item) for queue in self.out_queues]
+        self.relay(item)
+
+    def joined(self, server, channel):
+        # Lines for a channel are held until we are in it, then it relays without waiting on the rest
+        sender = self.irc_senders[server]
+        membership = self.members[server]
+        if not sender.release(membership.channel_names.get(membership.fold(channel), channel)):
+            return
+        if not sender.held and server in self.connect_started:
+            self.log.info("{} ready, joined {} channels in {:.2f}s".format(
+                server, len(self.irc_channels[server]), time() - self.connect_started.pop(server)))
+
+    def join_timeout(self, server):
+        sender = self.irc_senders.get(server)
+        if sender is not None and sender.held:
+            self.log.warning("Not in {} on {} yet, sending to them anyway".format(", ".join(sorted(sender.held)), server))
+            for channel in list(sender.held):
+                sender.release(channel)
+            self.connect_started.pop(server, None)
 
     def irc_part(self, connection, event):
+        self.members[connection.server].part(event.target, event.source.nick)
         item = events.Part(src=(connection.server, event.target), user=event.source.nick)
-        [queue.put_nowait(item) for queue in self.out_queues]
+        self.relay(item)
 
     def irc_quit(self, connection, event):
-        for channel, nick_list in self.irc_channels[connection.server].items():
-            if event.source.nick in nick_list:
-                nick_list.discard(event.source.nick)
-                item = events.Part(src=(connection.server, channel), user=event.source.nick)
-                [queue.put_nowait(item) for queue in self.out_queues]
+        reason = event.arguments[0] if event.arguments else None
+        for channel in self.members[connection.server].quit(event.source.nick):
+            item = events.Part(src=(connection.server, channel), user=event.source.nick, msg=reason)
+            self.relay(item)
 
     def irc_kick(self, connection, event):
+        self.members[connection.server].part(event.target, event.arguments[0])
         item = events.Kick(src=(connection.server, event.target), user=event.source.nick, msg=event.arguments)
-        [queue.put_nowait(item) for queue in self.out_queues]
+        self.relay(item)
+
+    def irc_nick(self, connection, event):
+        self.members[connection.server].rename(event.source.nick, event.target)
 
     def irc_nicknameinuse(self, connection, event):
         self.log.warning("Nickname in use, using {}".format(connection.get_nickname() + "_"))
         connection.nick(connection.get_nickname() + "_")
 
-        for channel in self.irc_channels[connection.server].keys():
+        for channel in self.irc_channels[connection.server]:
             connection.join(channel)
 
     def irc_namreply(self, connection, event):
         ch_type, channel, nick_list = event.arguments
+        self.members[connection.server].names(channel, nick_list.split(), "".join(connection.features.prefix))
 
-        for nick in nick_list.split():
-            nick_modes = []
-
-            if nick[0] in connection.features.prefix:
-                nick_modes.append(connection.features.prefix[nick[0]])
-                nick = nick[1:]
+    def irc_endofnames(self, connection, event):
+        self.members[connection.server].end_names(event.arguments[0])
 
-            self.irc_channels[connection.server][channel].add(nick)
+    def irc_featurelist(self, connection, event):
+        # Nick and channel comparisons follow the server's CASEMAPPING
+        self.members[connection.server].set_casemapping(getattr(connection.features, 'casemapping', None))
 
     def irc_disconnect(self, connection, event):
         # TODO Reconnect
+        if connection.server not in self.irc_servers:
+            return  # Removed on reload, we left on purpose
         self.log.error("Disconnected from {}".format(connection.server))
+        self.lost(connection)
+
+    def lost(self, connection):
+        # Without a reconnect its lines would never go out, don't let them pile up
+        server = next((server for server, running in self.irc_servers.items() if running is connection), None)
+        if server is None:
+            return  # Removed on reload meanwhile
+        self.disconnected.add(server)
+        dropped = self.irc_senders[server].discard()
+        if dropped:
+            self.log.warning("Dropped {} unsent lines for {}".format(dropped, server))
@@ -0,0 +1,113 @@
+from collections import OrderedDict, deque
+from relaygram import metrics
+from relaygram.ratelimit import TokenBucket
+
+
+HIGH, LOW = 0, 1  # Chat lines are kept over join/part notices
+
+
+class IRCSender:
+    """Flood-controlled outbound PRIVMSG scheduler for a single IRC server.
+
+    Lines are queued per channel and released by pump() as the server's token bucket allows, taking one line from
+    each waiting channel in turn so a long paste in one channel can't starve the others. pump() never blocks, it
+    returns how long until it can send again so the caller can fold that into its own select() timeout.
+
+    At most `max_backlog` lines wait for each channel. Past that, whole messages are dropped to make room, notices
+    before chat, oldest first, so a channel that can't keep up only loses its own lines.
+    """
+
+    def __init__(self, connection, rate=1.0, burst=4, max_backlog=0):
+        self.connection = connection
+        self.bucket = TokenBucket(rate, burst)
+        self.max_backlog = max_backlog
+        self.pending = OrderedDict()  # channel -> deque of (priority, deque of lines, on_sent), in round-robin order
+        self.held = set()  # Channels whose lines wait, because we haven't joined them yet
+        self.lines = 0  # Lines waiting, over all channels
+        self.counts = {}  # channel -> lines waiting for it
+
+    def queue(self, channel, lines, on_sent=None, priority=HIGH):
+        """Queue lines for a channel, on_sent is called once the last of them has gone out (or been dropped)."""
+        pending = self.pending.setdefault(channel, deque())
+        while self.max_backlog and self.counts.get(channel, 0) + len(lines) > self.max_backlog:
+            victim = next((i for i, entry in enumerate(pending) if entry[0] == LOW), None)
+            if victim is None:
+                if priority == LOW:
+                    self.dropped(on_sent)  # Nothing less important waiting than this one
+                    if not pending:
+                        del self.pending[channel]
+                    return
+                if not pending:
+                    break  # Longer than the whole backlog on its own, let it through
+                victim = 0  # Only chat waiting, the oldest goes
+            _, dropped_lines, dropped_sent = pending[victim]
+            del pending[victim]
+            self.lines -= len(dropped_lines)
+            self.counts[channel] -= len(dropped_lines)
+            self.dropped(dropped_sent)
+        pending.append((priority, deque(lines), on_sent))
+        self.lines += len(lines)
+        self.counts[channel] = self.counts.get(channel, 0) + len(lines)
+
+    @staticmethod
+    def dropped(on_sent):
+        metrics.EVENTS_DROPPED.inc(network="irc", reason="overflow")
+        if on_sent is not None:
+            on_sent()
+
+    def hold(self, channel):
+        self.held.add(channel)
+
+    def release(self, channel):
+        """Let a held channel's lines go, returns whether it was held."""
+        if channel not in self.held:
+            return False
+        self.held.discard(channel)
+        return True
+
+    def backlog(self):
+        """Lines waiting to be sent."""
+        return self.lines
+
+    def discard(self, channel=None):
+        """Drop the lines waiting for a channel, or for all of them, returns how many. Their on_sent callbacks still run,
+        so nothing waits on lines that will never go out."""
+        dropped = 0
+        for name in [channel] if channel is not None else list(self.pending):
+            self.counts.pop(name, None)
+            for _, lines, on_sent in self.pending.pop(name, ()):
+                dropped += len(lines)
+                if on_sent is not None:
+                    on_sent()
+        self.lines -= dropped
+        return dropped
+
+    def pump(self):
+        """Send what the bucket allows, returns seconds until the next line is due or None when idle."""
+        while self.pending:
+            if not self.connection.is_connected():
+                return None  # Hold everything until we are back
+
+            channel = next((channel for channel in self.pending if channel not in self.held), None)
+            if channel is None:
+                return None  # All that is left waits on a join
+            entries = self.pending[channel]
+            _, lines, on_sent = entries[0]
+            if lines and not self.bucket.consume():
+                return self.bucket.delay()
+
+            del self.pending[channel]
+            if lines:
+                self.connection.privmsg(channel, lines.popleft())
+                self.lines -= 1
+                self.counts[channel] -= 1
+                metrics.MESSAGES_SENT.inc(network="irc")
+            if not lines:
+                entries.popleft()
+                if on_sent is not None:
+                    on_sent()  # Everything queued before it has been sent
+            if entries:
+                self.pending[channel] = entries  # Back of the line
+            else:
+                self.counts.pop(channel, None)
+        return None
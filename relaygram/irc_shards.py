@@ -0,0 +1,106 @@
+from threading import Lock
+import logging
+
+from relaygram import metrics
+from relaygram.irc import IRCHandler
+from relaygram.queues import DropPolicy, SelectableQueue
+
+
+class IRCShards:
+    """Runs the configured IRC servers on several reactor threads instead of one.
+
+    Servers are dealt out round-robin over `shards` IRCHandlers, each with its own reactor, queue and senders, so a
+    slow network or a huge NAMES burst only holds up the servers that share its thread. This object takes the place
+    of the IRC queue: events put here are handed to every shard that owns one of their destinations. It also stands
+    in for the journal towards the shards, and acks an event only after each shard it was given to is done with it.
+    """
+
+    CONNECTION_KEYS = ('port', 'nickname', 'flood_rate', 'flood_burst')  # Only read when connecting
+
+    def __init__(self, channel_map, config, out_queues, journal=None, shards=1, media_store=None, open_socket=None):
+        self.log = logging.getLogger("relaygram.irc")
+        self.channel_map = channel_map
+        self.journal = journal
+
+        self.lock = Lock()
+        self.unacked = {}  # seq -> shards still working on it
+
+        servers = list(config['irc']['servers'].items())
+        count = max(1, min(shards, len(servers)) if shards else len(servers))  # 0 gives every server its own thread
+        self.handlers = []
+        self.server_shard = {}  # hostname -> handler
+        self.servers = {}  # hostname -> the server's config, as it is running
+        for index in range(count):
+            shard_servers = dict(servers[index::count])
+            policy = DropPolicy("irc_shard{}".format(index), "irc", config['irc'].get('queue_size', 1000),
+                                config['irc'].get('drop_policy'))
+            handler = IRCHandler(channel_map, config, SelectableQueue(policy), out_queues, self, shard_servers, media_store,
+                                 open_socket)
+            policy.on_drop = handler.ack
+            self.handlers.append(handler)
+            metrics.QUEUE_DEPTH.set_function(handler.my_queue.qsize, queue="irc_shard{}".format(index))
+            for server_params in shard_servers.values():
+                self.server_shard[server_params['hostname']] = handler
+                self.servers[server_params['hostname']] = server_params
+            self.log.info("IRC shard {}: {}".format(index, ", ".join(shard_servers)))
+
+    def run(self):
+        for handler in self.handlers:
+            handler.run()
+        return self
+
+    def reconfigure(self, servers):
+        """Bring the running servers in line with a reloaded irc.servers, leaving alone whatever didn't change.
+
+        Removed servers are left, new ones connected on the shard with the fewest servers, and servers in both only
+        join and part the channels that differ. The work itself runs on each shard's own thread.
+        """
+        wanted = {server_params['hostname']: server_params for server_params in servers.values()}
+        for hostname in list(self.servers.keys() - wanted.keys()):
+            handler = self.server_shard.pop(hostname)
+            del self.servers[hostname]
+            handler.call_soon(handler.remove_server, hostname)
+
+        for hostname, server_params in wanted.items():
+            running = self.servers.get(hostname)
+            if running is None:
+                handler = min(self.handlers, key=lambda handler: list(self.server_shard.values()).count(handler))
+                self.server_shard[hostname] = handler
+                self.servers[hostname] = server_params
+                handler.call_soon(handler.add_server, server_params)
+            else:
+                handler = self.server_shard[hostname]
+                changed = [key for key in self.CONNECTION_KEYS if running.get(key) != server_params.get(key)]
+                if changed:
+                    self.log.warning("Changing {} of {} needs a restart".format(", ".join(changed), hostname))
+                if list(running['channels']) != list(server_params['channels']):
+                    handler.call_soon(handler.set_channels, hostname, list(server_params['channels']))
+                    self.servers[hostname] = dict(running, channels=list(server_params['channels']))
+
+    def put_nowait(self, item):
+        handlers = []
+        for server, channel in self.channel_map.route(item.src):
+            handler = self.server_shard.get(server)
+            if handler is not None and handler not in handlers:
+                handlers.append(handler)
+
+        if not handlers:
+            self.ack("irc", item.seq)  # Nowhere to send it
+            return
+
+        if item.seq is not None:
+            with self.lock:
+                self.unacked[item.seq] = len(handlers)
+        for handler in handlers:
+            handler.my_queue.put_nowait(item)
+
+    def ack(self, name, seq):
+        if seq is None:
+            return
+        with self.lock:
+            remaining = self.unacked.pop(seq, 1) - 1
+            if remaining:
+                self.unacked[seq] = remaining
+                return
+        if self.journal is not None:
+            self.journal.ack(name, seq)
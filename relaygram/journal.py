@@ -0,0 +1,289 @@
+from threading import Condition, Thread
+import logging
+import os
+import struct
+import zlib
+
+from relaygram import events
+
+# Record kinds
+EVENT = 1   # (destination, seq, type name, src, user, msg, ts)
+ACK = 2     # (destination, seq)
+OFFSET = 3  # (telegram update offset,)
+HOLD = 4    # (id, value) waiting outside the queues until released, handed back on restart
+RELEASE = 5  # (id,)
+
+HEADER = struct.Struct('<IIB')  # payload length, crc32 of kind and payload, kind
+
+
+def encode_varint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def encode_value(value, out):
+    if value is None:
+        out += b'N'
+    elif isinstance(value, int):
+        out += b'i'
+        encode_varint((value << 1) ^ (value >> 63), out)  # Zigzag, so small negative chat ids stay small
+    elif isinstance(value, float):
+        out += b'f'
+        out += struct.pack('<d', value)
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        out += b's'
+        encode_varint(len(data), out)
+        out += data
+    elif isinstance(value, (tuple, list)):
+        out += b't'
+        encode_varint(len(value), out)
+        for item in value:
+            encode_value(item, out)
+    else:
+        raise TypeError("Can't journal a {}".format(type(value).__name__))
+
+
+def decode_value(data, pos):
+    tag = data[pos:pos + 1]
+    pos += 1
+    if tag == b'N':
+        return None, pos
+    elif tag == b'i':
+        value, pos = decode_varint(data, pos)
+        return (value >> 1) ^ -(value & 1), pos
+    elif tag == b'f':
+        return struct.unpack_from('<d', data, pos)[0], pos + 8
+    elif tag == b's':
+        length, pos = decode_varint(data, pos)
+        return bytes(data[pos:pos + length]).decode('utf-8'), pos + length
+    elif tag == b't':
+        count, pos = decode_varint(data, pos)
+        items = []
+        for _ in range(count):
+            item, pos = decode_value(data, pos)
+            items.append(item)
+        return tuple(items), pos
+    raise ValueError("Bad journal value tag {!r}".format(tag))
+
+
+def encode_record(kind, value):
+    payload = bytearray()
+    encode_value(value, payload)
+    return HEADER.pack(len(payload), zlib.crc32(bytes([kind]) + payload), kind) + payload
+
+
+class JournalLane:
+    """Stands in for a destination queue: events put here are journaled first and reach the queue once on disk."""
+
+    def __init__(self, journal, name, queue):
+        self.journal = journal
+        self.name = name
+        self.queue = queue
+
+    def put_nowait(self, item):
+        self.journal.append(self.name, item)
+
+
+class Journal:
+    """Append-only log of relayed events, so a restart or crash doesn't lose what was still queued.
+
+    Producers put events on a JournalLane instead of a destination queue. A writer thread collects everything
+    appended since its last pass, writes it with a single write and fsync (group commit), and only then hands the
+    events to their queues. Consumers ack each event once it has been delivered. On startup the log is read back and
+    every event its destination never acked is queued again, and the Telegram update offset is restored, so the
+    bridge carries on from where it stopped.
+
+    Work that has to survive a restart before it can become an event, like a download in progress, is kept with
+    hold() until it is released. sync() waits until everything so far is on disk.
+
+    The log is rewritten with only the undelivered events and unreleased holds once it grows past `compact_bytes`.
+    """
+
+    def __init__(self, filename, fsync=True, compact_bytes=4 * 1024 * 1024):
+        self.log = logging.getLogger("relaygram.journal")
+        self.filename = filename
+        self.fsync = fsync
+        self.compact_bytes = compact_bytes
+
+        self.compacted_size = 0
+        self.lanes = {}
+        self.live = {}  # destination -> {seq: (event, record)} not yet acked
+        self.held = {}  # id -> (value, record) not yet released
+        self.next_seq = 0
+        self.offset = 0
+        self.appended = 0  # Batches handed to the writer, and how many of them it has written
+        self.written = 0
+
+        self.cond = Condition()
+        self.pending = bytearray()
+        self.deliveries = []
+
+        self.load()
+        self.file = open(self.filename, 'ab')
+
+        self.thread = Thread(target=self.writer_loop, daemon=True)
+
+    def destination(self, name, queue):
+        lane = JournalLane(self, name, queue)
+        self.lanes[name] = lane
+        self.live.setdefault(name, {})
+        return lane
+
+    def run(self):
+        # Requeue what didn't get delivered last time, before anything new can be appended behind it
+        for name, lane in self.lanes.items():
+            backlog = sorted(self.live[name].items())
+            if backlog:
+                self.log.info("Replaying {} undelivered events to {}".format(len(backlog), name))
+            for seq, (event, record) in backlog:
+                lane.queue.put_nowait(event)
+        self.thread.start()
+        return self
+
+    def load(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+
+        pos = 0
+        while pos + HEADER.size <= len(data):
+            length, crc, kind = HEADER.unpack_from(data, pos)
+            end = pos + HEADER.size + length
+            payload = data[pos + HEADER.size:end]
+            if end > len(data) or zlib.crc32(bytes([kind]) + payload) != crc:
+                break  # Torn write from a crash, everything after it is garbage
+            value = decode_value(payload, 0)[0]
+
+            if kind == EVENT:
+                name, seq, type_name, src, user, msg = value[:6]
+                ts = value[6] if len(value) > 6 else None  # Older journals didn't record it
+                event_type = getattr(events, type_name)
+                event = event_type._make((event_type, src, user, msg, seq, ts))
+                self.live.setdefault(name, {})[seq] = (event, data[pos:end])
+                self.next_seq = max(self.next_seq, seq + 1)
+            elif kind == ACK:
+                name, seq = value
+                self.live.get(name, {}).pop(seq, None)
+            elif kind == OFFSET:
+                self.offset = value[0]
+            elif kind == HOLD:
+                self.held[value[0]] = (value[1], data[pos:end])
+                self.next_seq = max(self.next_seq, value[0] + 1)
+            elif kind == RELEASE:
+                self.held.pop(value[0], None)
+            pos = end
+
+        if pos != len(data):
+            self.log.warning("Discarding {} bytes of damaged journal".format(len(data) - pos))
+            with open(self.filename, 'r+b') as f:
+                f.truncate(pos)
+
+    def append(self, name, event):
+        with self.cond:
+            event = event._replace(seq=self.next_seq)
+            self.next_seq += 1
+            record = encode_record(EVENT, (name, event.seq, event.type.__name__, event.src, event.user, event.msg, event.ts))
+            self.live[name][event.seq] = (event, record)
+            self.pending += record
+            self.deliveries.append((self.lanes[name].queue, event))
+            self.cond.notify_all()
+
+    def ack(self, name, seq):
+        with self.cond:
+            if self.live[name].pop(seq, None) is not None:
+                self.pending += encode_record(ACK, (name, seq))
+                self.cond.notify_all()
+
+    def set_offset(self, offset):
+        with self.cond:
+            if offset != self.offset:
+                self.offset = offset
+                self.pending += encode_record(OFFSET, (offset,))
+                self.cond.notify_all()
+
+    def hold(self, value):
+        """Keep value until release(), returns the id to release it by."""
+        with self.cond:
+            hold_id = self.next_seq
+            self.next_seq += 1
+            record = encode_record(HOLD, (hold_id, value))
+            self.held[hold_id] = (value, record)
+            self.pending += record
+            self.cond.notify_all()
+            return hold_id
+
+    def release(self, hold_id):
+        with self.cond:
+            if self.held.pop(hold_id, None) is not None:
+                self.pending += encode_record(RELEASE, (hold_id,))
+                self.cond.notify_all()
+
+    def holds(self):
+        """(id, value) of everything still held, oldest first."""
+        with self.cond:
+            return [(hold_id, value) for hold_id, (value, record) in sorted(self.held.items())]
+
+    def sync(self):
+        """Wait until everything appended so far has been written."""
+        with self.cond:
+            target = self.appended + (1 if self.pending else 0)
+            self.cond.wait_for(lambda: self.written >= target)
+
+    def writer_loop(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending)
+                batch, self.pending = self.pending, bytearray()
+                deliveries, self.deliveries = self.deliveries, []
+                self.appended += 1
+
+            try:
+                self.file.write(batch)
+                self.file.flush()
+                if self.fsync:
+                    os.fsync(self.file.fileno())
+            except OSError:
+                self.log.exception("Failed to write journal, relaying anyway")
+            with self.cond:
+                self.written += 1
+                self.cond.notify_all()
+
+            for queue, event in deliveries:
+                queue.put_nowait(event)
+
+            if self.file.tell() > max(self.compact_bytes, 2 * self.compacted_size):
+                self.compact()
+
+    def compact(self):
+        # Rewrite the log with just the current offset and the events still waiting to be acked
+        with self.cond:
+            records = [encode_record(OFFSET, (self.offset,))]
+            records += [record for live in self.live.values() for seq, (event, record) in sorted(live.items())]
+            records += [record for hold_id, (value, record) in sorted(self.held.items())]
+            # Anything appended meanwhile is still in self.pending and will land in the new file
+
+            tmp_filename = self.filename + ".tmp"
+            with open(tmp_filename, 'wb') as f:
+                f.write(b''.join(records))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_filename, self.filename)
+            self.file.close()
+            self.file = open(self.filename, 'ab')
+            self.compacted_size = self.file.tell()
@@ -0,0 +1,177 @@
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Lock
+from time import monotonic
+import hashlib
+import logging
+import mimetypes
+import os
+import uuid
+
+import twx.botapi
+
+from relaygram import events, metrics
+from relaygram.transcode import Transcoder
+
+# What the journal keeps of each held slot, so it can be redone after a restart
+DOWNLOAD = "download"  # (kind, chat id, file id, file size, pattern, ((field, value), ...), type, src, user, ts)
+HELD = "held"  # (kind, chat id, type, src, user, msg, ts)
+
+Media = namedtuple("Media", "file_id, file_size")  # The parts of a twx file a download needs
+
+
+class MediaSlot:
+    __slots__ = ('ready', 'item', 'hold_id')
+
+    def __init__(self, ready=False, item=None, hold_id=None):
+        self.ready = ready
+        self.item = item
+        self.hold_id = hold_id
+
+
+class MediaPipeline:
+    """Downloads Telegram media on a bounded pool of workers, off the polling thread.
+
+    Every event for a chat goes through here so ordering is kept: an event is only handed to `relay` once all media
+    queued before it in the same chat has finished downloading. Chats without pending media pass straight through.
+
+    Once the next getUpdates has gone out Telegram won't send an update again, so with a journal every download and
+    every event held behind one is kept there too, until it has been relayed. resume() picks them up after a restart.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, twx_bot, config, store, relay, transport, journal=None):
+        self.log = logging.getLogger("relaygram.media")
+        self.twx = twx_bot
+        self.transport = transport
+        self.config = config
+        self.relay = relay
+        self.journal = journal
+
+        self.store = store
+        self.transcoder = Transcoder(config, store.retention)
+        self.executor = ThreadPoolExecutor(max_workers=self.config['media'].get('download_workers', 4))
+        self.max_inflight_bytes = self.config['media'].get('download_inflight_mb', 64) * 1024 * 1024
+        self.inflight_bytes = 0
+        self.inflight = Condition()
+
+        self.chats = {}  # chat id -> deque of MediaSlots, oldest first
+        self.lock = Lock()
+
+    def emit(self, chat_id, item):
+        """Relay an event that needs no download, after any media still pending in the same chat."""
+        with self.lock:
+            pending = self.chats.get(chat_id)
+            if not pending:
+                self.relay(item)
+            else:
+                record = (HELD, chat_id, item.type.__name__, item.src, item.user, item.msg, item.ts)
+                pending.append(MediaSlot(ready=True, item=item, hold_id=self.hold(record)))
+
+    def submit(self, chat_id, media, item, pattern, **fields):
+        """Download `media` in the background, then relay `item` in chat order. Its msg is `pattern` filled in with
+        `fields` and the file's url and mime type."""
+        record = (DOWNLOAD, chat_id, media.file_id, media.file_size or 0, pattern, tuple(sorted(fields.items())),
+                  item.type.__name__, item.src, item.user, item.ts)
+        with self.lock:
+            slot = MediaSlot(hold_id=self.hold(record))
+            self.chats.setdefault(chat_id, deque()).append(slot)
+        self.executor.submit(self.process, chat_id, slot, media, item, pattern, fields)
+
+    def hold(self, record):
+        return self.journal.hold(record) if self.journal is not None else None
+
+    def resume(self):
+        """Redo the downloads and held events a restart interrupted, in their original order."""
+        holds = self.journal.holds() if self.journal is not None else []
+        if holds:
+            self.log.info("Resuming {} media downloads and held events".format(len(holds)))
+        for hold_id, record in holds:
+            if record[0] == DOWNLOAD:
+                _, chat_id, file_id, file_size, pattern, fields, type_name, src, user, ts = record
+                item = self.make_event(type_name, src, user, None, ts)
+                self.submit(chat_id, Media(file_id, file_size), item, pattern, **dict(fields))
+            else:
+                _, chat_id, type_name, src, user, msg, ts = record
+                self.emit(chat_id, self.make_event(type_name, src, user, msg, ts))
+            self.journal.release(hold_id)  # Held again above, under a new id
+
+    @staticmethod
+    def make_event(type_name, src, user, msg, ts):
+        event_type = getattr(events, type_name)
+        return event_type._make((event_type, src, user, msg, None, ts))
+
+    def process(self, chat_id, slot, media, item, pattern, fields):
+        try:
+            filename = self.fetch(media)
+            slot.item = item._replace(msg=pattern.format(url=self.config['media']['base_url'] + filename,
+                                                         mime=mimetypes.guess_type(filename)[0], **fields))
+        except Exception:
+            self.log.exception("Failed to download media {}".format(media.file_id))
+
+        with self.lock:
+            slot.ready = True
+            pending = self.chats[chat_id]
+            while pending and pending[0].ready:
+                done = pending.popleft()
+                if done.item is not None:
+                    self.relay(done.item)  # Journaled as an event from here on
+                if done.hold_id is not None:
+                    self.journal.release(done.hold_id)
+            if not pending:
+                del self.chats[chat_id]
+
+    def fetch(self, media):
+        unique_id = self.transport.unique_id(media.file_id)
+        filename = self.store.lookup(unique_id)
+        if filename is not None:
+            return filename  # Seen it before, no need to bother the Bot API
+
+        # Cap the reservation so a single file larger than the budget can still go through on its own
+        reserved = min(media.file_size or 0, self.max_inflight_bytes)
+        with self.inflight:
+            self.inflight.wait_for(lambda: self.inflight_bytes + reserved <= self.max_inflight_bytes)
+            self.inflight_bytes += reserved
+        started = monotonic()
+        try:
+            file = self.twx.get_file(media.file_id).wait()
+            if file is None or isinstance(file, twx.botapi.Error):
+                raise IOError("Could not look up telegram file: {}".format(file and file.description))
+            filename = self.store_telegram_media(file, unique_id)
+            metrics.MEDIA_DOWNLOAD.observe(monotonic() - started, result="ok")
+            self.transcoder.submit(filename)  # Previews and conversions are made in the background
+            return filename
+        except Exception:
+            metrics.MEDIA_DOWNLOAD.observe(monotonic() - started, result="failed")
+            raise
+        finally:
+            with self.inflight:
+                self.inflight_bytes -= reserved
+                self.inflight.notify_all()
+
+    def store_telegram_media(self, file, unique_id):
+        tmp_file = os.path.join(self.config['media_dir'], "{}.part".format(uuid.uuid4().hex))
+        digest = self.download(file.file_path, tmp_file)
+        return self.store.add(unique_id, digest, tmp_file, os.path.splitext(file.file_path)[1])
+
+    def download(self, file_path, out_file):
+        """Stream a file from Telegram to out_file, returns the sha256 of its contents."""
+        url = "{}{}/{}".format(twx.botapi.TelegramDownloadRequest.download_url_base, self.twx.token, file_path)
+        digest = hashlib.sha256()
+        try:
+            resp = self.transport.download(url, self.config['media'].get('download_timeout', 60))
+            try:
+                resp.raise_for_status()
+                with open(out_file, 'wb') as f:
+                    for chunk in resp.iter_content(chunk_size=self.CHUNK_SIZE):
+                        digest.update(chunk)
+                        f.write(chunk)
+                        metrics.MEDIA_BYTES.inc(len(chunk))
+            finally:
+                resp.close()
+        except Exception:
+            if os.path.exists(out_file):
+                os.remove(out_file)
+            raise
+        return digest.hexdigest()
@@ -0,0 +1,109 @@
+from threading import Lock
+import hashlib
+import json
+import os
+import random
+import string
+import uuid
+
+from relaygram.retention import MediaRetention
+
+class MediaStore:
+    """Content addressed store for media downloaded from Telegram.
+
+    Files are indexed by Telegram's file_unique_id, so a repeated sticker or forward is served from disk without
+    asking the Bot API for it again, and by the sha256 of their contents, so identical files uploaded under different
+    ids share a single copy. The index lives next to the config as media_index.json.
+
+    Everything written to media_dir should go through add() so retention knows about it.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.media_dir = config['media_dir']
+        self.filename = os.path.join(config['config_dir'], "media_index.json")
+        self.lock = Lock()
+        self.index = {
+            'unique_id': {},
+            'sha256': {},
+        }
+
+        self.reload()
+
+        self.retention = MediaRetention(config, on_evict=self.forget)
+
+    def run(self):
+        self.retention.run()
+        return self
+
+    def reload(self):
+        try:
+            with open(self.filename, 'r') as f:
+                self.index = json.load(f)
+        except FileNotFoundError:
+            pass  # Start with an empty index
+
+    def save(self):
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_filename, self.filename)
+
+    def lookup(self, unique_id):
+        """Return the stored filename for a Telegram file_unique_id, or None if we don't have it."""
+        if unique_id is None:
+            return None
+        with self.lock:
+            filename = self.index['unique_id'].get(unique_id)
+            if filename is not None and not os.path.exists(os.path.join(self.media_dir, filename)):
+                del self.index['unique_id'][unique_id]  # Deleted behind our back
+                return None
+        if filename is not None:
+            self.retention.touch(filename)
+        return filename
+
+    def add(self, unique_id, digest, tmp_file, ext):
+        """Move a finished download into the store and return its filename, reusing an identical file if we have one."""
+        with self.lock:
+            filename = self.index['sha256'].get(digest)
+            if filename is not None and os.path.exists(os.path.join(self.media_dir, filename)):
+                os.remove(tmp_file)
+                self.retention.touch(filename)
+            else:
+                filename = self.new_name(digest, ext)
+                out_file = os.path.join(self.media_dir, filename)
+                os.replace(tmp_file, out_file)
+                self.index['sha256'][digest] = filename
+                self.retention.added(filename, os.path.getsize(out_file))
+
+            if unique_id is not None:
+                self.index['unique_id'][unique_id] = filename
+            self.save()
+        return filename
+
+    def add_data(self, data, ext):
+        """Store bytes we made ourselves, such as an offloaded paste, and return the filename."""
+        tmp_file = os.path.join(self.media_dir, "{}.part".format(uuid.uuid4().hex))
+        with open(tmp_file, 'wb') as f:
+            f.write(data)
+        return self.add(None, hashlib.sha256(data).hexdigest(), tmp_file, ext)
+
+    def new_name(self, digest, ext):
+        # A random name keeps URLs unguessable, randomize_name_length: 0 names files after their contents instead
+        name_length = self.config['media'].get('randomize_name_length', 8)
+        if name_length <= 0:
+            return digest[:32] + ext
+
+        while True:
+            filename = "".join(random.choice(string.ascii_letters + string.digits) for _ in range(name_length)) + ext
+            if not os.path.exists(os.path.join(self.media_dir, filename)):
+                return filename
+
+    def forget(self, filenames):
+        """Drop evicted files from the index, so they are downloaded again if they turn up."""
+        filenames = set(filenames)
+        with self.lock:
+            for mapping in self.index.values():
+                for key in [key for key, filename in mapping.items() if filename in filenames]:
+                    del mapping[key]
+            self.save()
@@ -0,0 +1,118 @@
+CASEMAPPINGS = {
+    'ascii': str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz"),
+    'rfc1459': str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\~", "abcdefghijklmnopqrstuvwxyz{}|^"),
+    'strict-rfc1459': str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\", "abcdefghijklmnopqrstuvwxyz{}|"),
+}
+
+
+class Membership:
+    """Who is in which channel on one IRC server.
+
+    Two maps are kept in step, channel -> nicks and nick -> channels, so a QUIT or NICK only touches the channels
+    that nick is actually in rather than every channel on the server. Names are compared under the server's
+    CASEMAPPING, but reported as they were last seen. A NAMES listing is collected over all of its 353 replies and
+    replaces the channel's member list in one go at the 366, which also drops anyone we missed leaving.
+    """
+
+    def __init__(self, casemapping='rfc1459'):
+        self.fold_table = CASEMAPPINGS['rfc1459']
+        self.channels = {}  # folded channel -> {folded nick: nick}
+        self.channel_names = {}  # folded channel -> channel
+        self.nicks = {}  # folded nick -> set of folded channels
+        self.pending_names = {}  # folded channel -> {folded nick: nick} from a NAMES reply still coming in
+        self.set_casemapping(casemapping)
+
+    def fold(self, name):
+        return name.translate(self.fold_table)
+
+    def set_casemapping(self, casemapping):
+        table = CASEMAPPINGS.get((casemapping or 'rfc1459').lower(), CASEMAPPINGS['rfc1459'])
+        if table == self.fold_table:
+            return
+        self.fold_table = table
+
+        # Rebuild under the new folding, this only happens if the server announces it after we have joined
+        channels = {self.channel_names[channel]: list(nicks.values()) for channel, nicks in self.channels.items()}
+        self.channels, self.channel_names, self.nicks, self.pending_names = {}, {}, {}, {}
+        for channel, nicks in channels.items():
+            self.add_channel(channel)
+            for nick in nicks:
+                self.join(channel, nick)
+
+    def add_channel(self, channel):
+        key = self.fold(channel)
+        self.channels.setdefault(key, {})
+        self.channel_names[key] = channel
+
+    def remove_channel(self, channel):
+        key = self.fold(channel)
+        for nick_key in self.channels.pop(key, {}):
+            self.discard(nick_key, key)
+        self.channel_names.pop(key, None)
+        self.pending_names.pop(key, None)
+
+    def members(self, channel):
+        return list(self.channels.get(self.fold(channel), {}).values())
+
+    def join(self, channel, nick):
+        key, nick_key = self.fold(channel), self.fold(nick)
+        members = self.channels.get(key)
+        if members is None:
+            return
+        members[nick_key] = nick
+        self.nicks.setdefault(nick_key, set()).add(key)
+
+    def part(self, channel, nick):
+        """Returns whether the nick was in the channel."""
+        key, nick_key = self.fold(channel), self.fold(nick)
+        if self.channels.get(key, {}).pop(nick_key, None) is None:
+            return False
+        self.discard(nick_key, key)
+        return True
+
+    def quit(self, nick):
+        """Remove a nick from every channel, returns the channels it was in."""
+        nick_key = self.fold(nick)
+        channels = self.nicks.pop(nick_key, set())
+        for key in channels:
+            self.channels[key].pop(nick_key, None)
+        return [self.channel_names[key] for key in channels]
+
+    def rename(self, old, new):
+        """Follow a NICK change, returns the channels it was seen in."""
+        old_key, new_key = self.fold(old), self.fold(new)
+        channels = self.nicks.pop(old_key, set())
+        for key in channels:
+            members = self.channels[key]
+            members.pop(old_key, None)
+            members[new_key] = new
+        if channels:
+            self.nicks.setdefault(new_key, set()).update(channels)
+        return [self.channel_names[key] for key in channels]
+
+    def names(self, channel, nicks, prefixes=""):
+        """Collect one RPL_NAMREPLY, applied by end_names(). `prefixes` are the status characters to strip."""
+        pending = self.pending_names.setdefault(self.fold(channel), {})
+        for nick in nicks:
+            nick = nick.lstrip(prefixes)  # Servers with multi-prefix send several, e.g. "@+nick"
+            if nick:
+                pending[self.fold(nick)] = nick
+
+    def end_names(self, channel):
+        key = self.fold(channel)
+        pending = self.pending_names.pop(key, None)
+        if pending is None or key not in self.channels:
+            return
+
+        for nick_key in self.channels[key].keys() - pending.keys():
+            self.discard(nick_key, key)
+        for nick_key in pending.keys() - self.channels[key].keys():
+            self.nicks.setdefault(nick_key, set()).add(key)
+        self.channels[key] = pending
+
+    def discard(self, nick_key, key):
+        channels = self.nicks.get(nick_key)
+        if channels is not None:
+            channels.discard(key)
+            if not channels:
+                del self.nicks[nick_key]
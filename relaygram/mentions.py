@@ -0,0 +1,42 @@
+from collections import OrderedDict
+from threading import Lock
+import re
+
+
+class MentionMatcher:
+    """Turns the names of Telegram users seen in a chat into @mentions in text relayed to that chat.
+
+    Telegram usernames only contain word characters, so rather than trying every known name against the message
+    we walk its words once with a precompiled pattern and look each one up in the chat's name table. The cost is one
+    pass over the message however many users a chat has, and adding a name never requires recompiling anything.
+    Each chat keeps at most `max_users` names, forgetting whoever has been quiet the longest.
+    """
+
+    WORD_RE = re.compile(r'(?<!@)\b\w+\b')
+
+    def __init__(self, max_users=1000):
+        self.max_users = max_users
+        self.chats = {}  # chat id -> OrderedDict of lowercase name -> username, least recently seen first
+        self.lock = Lock()
+
+    def seen(self, chat_id, username):
+        if not username:
+            return
+
+        with self.lock:
+            names = self.chats.setdefault(chat_id, OrderedDict())
+            names[username.lower()] = username
+            names.move_to_end(username.lower())
+            if len(names) > self.max_users:
+                names.popitem(last=False)
+
+    def convert(self, chat_id, msg):
+        names = self.chats.get(chat_id)
+        if not names:
+            return msg
+
+        def mention(match):
+            username = names.get(match.group(0).lower())
+            return "@" + username if username else match.group(0)
+
+        return self.WORD_RE.sub(mention, msg)
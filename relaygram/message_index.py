@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from threading import Lock, Timer
+import json
+import os
+
+
+class MessageIndex:
+    """Remembers where the messages we relayed into Telegram came from.
+
+    Every message sendMessage returns is recorded under its chat and message id, with the IRC nick and the
+    (server, channel) it was relayed from, so a reply to it can be attributed with a dict lookup whatever the
+    message patterns look like. When several lines were merged into one message, it is attributed to the first.
+    At most `max_entries` messages are kept, the least recently used are forgotten first.
+
+    With a filename the index survives restarts. Changes are written behind like the channel map's, batched over
+    `save_delay` seconds, oldest entry first.
+    """
+
+    def __init__(self, max_entries=10000, filename=None, save_delay=5.0):
+        self.max_entries = max_entries
+        self.filename = filename
+        self.save_delay = save_delay
+        self.entries = OrderedDict()  # (chat id, message id) -> (nick, (server, channel)), least recently used first
+        self.lock = Lock()
+        self.save_timer = None
+
+        if self.filename is not None:
+            self.reload()
+
+    def reload(self):
+        try:
+            with open(self.filename, 'r') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return  # Nothing sent yet
+
+        with self.lock:
+            for chat_id, message_id, nick, server, channel in entries[-self.max_entries:]:
+                self.entries[(chat_id, message_id)] = (nick, (server, channel))
+
+    def add(self, chat_id, message_id, nick, src):
+        with self.lock:
+            self.entries[(chat_id, message_id)] = (nick, tuple(src))
+            self.entries.move_to_end((chat_id, message_id))
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        self.save()
+
+    def lookup(self, chat_id, message_id):
+        """(nick, (server, channel)) a message we sent was relayed from, or None if we don't know it."""
+        with self.lock:
+            entry = self.entries.get((chat_id, message_id))
+            if entry is not None:
+                self.entries.move_to_end((chat_id, message_id))
+            return entry
+
+    def save(self):
+        if self.filename is None:
+            return
+        with self.lock:
+            if self.save_timer is None:
+                self.save_timer = Timer(self.save_delay, self.flush)
+                self.save_timer.daemon = True
+                self.save_timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.save_timer = None
+            entries = [[chat_id, message_id, nick, src[0], src[1]]
+                       for (chat_id, message_id), (nick, src) in self.entries.items()]
+
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp_filename, self.filename)
@@ -0,0 +1,154 @@
+from bisect import bisect_left
+from threading import Lock
+import logging
+
+log = logging.getLogger("relaygram.metrics")
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+    return "{" + ",".join('{}="{}"'.format(name, escape(value)) for name, value in pairs) + "}"
+
+
+def format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = Lock()
+        self.values = {}  # label values -> value
+
+    def key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, (), value) for key, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.kind)]
+        for name, key, extra, value in self.samples():
+            lines.append("{}{} {}".format(name, format_labels(self.labels, key, extra), format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=()):
+        super(Gauge, self).__init__(name, help, labels)
+        self.functions = {}  # label values -> callable read at scrape time
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def set_function(self, function, **labels):
+        """Report function() whenever metrics are collected, for values like queue depths that are cheap to read."""
+        with self.lock:
+            self.functions[self.key(labels)] = function
+
+    def remove(self, **labels):
+        with self.lock:
+            self.values.pop(self.key(labels), None)
+            self.functions.pop(self.key(labels), None)
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+            functions = dict(self.functions)
+        for key, function in functions.items():
+            try:
+                values[key] = function()
+            except Exception:
+                log.exception("Failed to collect {}".format(self.name))
+        return [(self.name, key, (), value) for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append((self.name + "_bucket", key, (("le", format_value(bound)),), cumulative))
+                samples.append((self.name + "_sum", key, (), total))
+                samples.append((self.name + "_count", key, (), cumulative))
+        return samples
+
+
+class Registry:
+    """Every metric the bridge keeps, rendered in the Prometheus text exposition format for /metrics."""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Events are stamped when they arrive from one network and observed again when the other network has been sent them
+RELAY_LATENCY = REGISTRY.register(Histogram(
+    "relaygram_relay_latency_seconds", "Time from an event arriving to it being sent on", ("direction",)))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "relaygram_queue_depth", "Events or lines waiting to be sent", ("queue",)))
+MESSAGES_SENT = REGISTRY.register(Counter(
+    "relaygram_messages_sent_total", "Messages sent to each network", ("network",)))
+SEND_RETRIES = REGISTRY.register(Counter(
+    "relaygram_send_retries_total", "Sends that failed and were queued again", ("network",)))
+EVENTS_DROPPED = REGISTRY.register(Counter(
+    "relaygram_events_dropped_total", "Events given up on without being delivered", ("network", "reason")))
+MEDIA_DOWNLOAD = REGISTRY.register(Histogram(
+    "relaygram_media_download_seconds", "Time to fetch and store a Telegram file", ("result",)))
+BOTAPI_LATENCY = REGISTRY.register(Histogram(
+    "relaygram_botapi_seconds", "Time taken by each Bot API call, getUpdates includes its long poll", ("method",)))
+MEDIA_BYTES = REGISTRY.register(Counter(
+    "relaygram_media_download_bytes_total", "Bytes downloaded from Telegram"))
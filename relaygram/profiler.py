@@ -0,0 +1,71 @@
+from collections import Counter
+from threading import Event, Thread
+import logging
+import sys
+import threading
+
+
+class SamplingProfiler:
+    """Where the bridge spends its time, across all of its threads.
+
+    cProfile only sees the thread it was started on, and the bridge's work is spread over reactor, poll, send and
+    download threads. So instead every thread's stack is sampled `interval` seconds apart. A function's self count
+    is how often it was the one running; its total count is how often it was anywhere on the stack. Threads blocked
+    in select() or a lock wait show up there too, read those as idle. write() dumps the functions by total count,
+    followed by the collapsed stacks a flame graph tool can read.
+    """
+
+    def __init__(self, interval=0.005):
+        self.log = logging.getLogger("relaygram.profiler")
+        self.interval = interval
+        self.samples = 0
+        self.own = Counter()  # function -> samples it was running in
+        self.total = Counter()  # function -> samples it was on the stack in
+        self.stacks = Counter()  # "outer;...;inner" -> samples
+
+        self.stopped = Event()
+        self.thread = Thread(target=self.sample_loop, daemon=True)
+
+    def run(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    @staticmethod
+    def describe(code):
+        return "{} ({}:{})".format(code.co_name, code.co_filename, code.co_firstlineno)
+
+    def sample_loop(self):
+        names = {}
+        while not self.stopped.wait(self.interval):
+            me = threading.get_ident()
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    if code not in names:
+                        names[code] = self.describe(code)
+                    stack.append(names[code])
+                    frame = frame.f_back
+                self.samples += 1
+                self.own[stack[0]] += 1
+                self.total.update(set(stack))  # Once per sample, however deep it recurses
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, filename, limit=50):
+        with open(filename, 'w') as f:
+            f.write("{} samples every {}ms, across all threads\n\n".format(self.samples, self.interval * 1000))
+            f.write("{:>8} {:>7} {:>8} {:>7}  function\n".format("total", "%", "self", "%"))
+            for function, count in self.total.most_common(limit):
+                f.write("{:8} {:6.1f}% {:8} {:6.1f}%  {}\n".format(
+                    count, 100.0 * count / self.samples, self.own[function], 100.0 * self.own[function] / self.samples,
+                    function))
+            f.write("\n# Collapsed stacks\n")
+            for stack, count in self.stacks.most_common():
+                f.write("{} {}\n".format(stack, count))
+        self.log.info("Wrote profile of {} samples to {}".format(self.samples, filename))
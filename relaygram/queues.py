@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import os
+from queue import Queue, Empty
+
+from relaygram import metrics
+
+
+class DropPolicy:
+    """What a full relay queue gives up, by event type.
+
+    Up to `maxsize` items are queued (0 for no limit). When one more arrives, the oldest queued event of a type set
+    to "drop" makes room for it. With none of those queued, a newcomer that may be dropped is, and otherwise the
+    oldest event goes. Each drop is passed to `on_drop`, so it can be acked, and counted in
+    relaygram_events_dropped_total. Each new high-water mark, in steps of a tenth of maxsize (or of 100 without one),
+    is logged.
+
+    `policies` maps type names to "drop" or "keep", unlisted types are kept. Without any, DEFAULTS apply.
+    """
+
+    DEFAULTS = {'Join': 'drop', 'Part': 'drop', 'Topic': 'drop', 'Summary': 'drop'}
+
+    def __init__(self, name, network, maxsize, policies=None, on_drop=None):
+        self.log = logging.getLogger("relaygram.queues")
+        self.name = name
+        self.network = network
+        self.maxsize = maxsize
+        self.on_drop = on_drop
+
+        if policies is None:
+            policies = self.DEFAULTS
+        for type_name, policy in policies.items():
+            if policy not in ('drop', 'keep'):
+                raise ValueError("Drop policy for {} must be drop or keep, not {}".format(type_name, policy))
+        self.droppable = {type_name for type_name, policy in policies.items() if policy == 'drop'}
+        self.step = max(1, maxsize // 10) if maxsize else 100
+        self.high_water = 0
+
+    def may_drop(self, item):
+        return item.type.__name__ in self.droppable
+
+    def admit(self, items, item):
+        """Append item to the deque `items`, making room as the policy says when it is full."""
+        victim = None
+        if self.maxsize and len(items) >= self.maxsize:
+            index = next((index for index, queued in enumerate(items) if self.may_drop(queued)), None)
+            if index is None and self.may_drop(item):
+                victim = item
+            else:
+                victim = items[index or 0]
+                del items[index or 0]
+        if victim is not item:
+            items.append(item)
+
+        if victim is not None:
+            metrics.EVENTS_DROPPED.inc(network=self.network, reason="overflow")
+            if self.on_drop is not None:
+                self.on_drop(victim)
+        if len(items) >= self.high_water + self.step:
+            self.high_water = len(items) - len(items) % self.step
+            self.log.warning("{} queue is at {} of {} events".format(self.name, len(items), self.maxsize or "unlimited"))
+
+    def emptied(self):
+        self.high_water = 0  # So the next backlog is reported from the start
+
+
+class RelayQueue(Queue):
+    """A Queue that holds relayed events under a DropPolicy, if it is given one."""
+
+    def __init__(self, policy=None):
+        super(RelayQueue, self).__init__()  # Unbounded as far as Queue knows, put() never blocks, the policy drops
+        self.policy = policy
+
+    def _put(self, item):
+        if self.policy is None:
+            super(RelayQueue, self)._put(item)
+        else:
+            self.policy.admit(self.queue, item)
+
+    def _get(self):
+        item = super(RelayQueue, self)._get()
+        if not self.queue and self.policy is not None:
+            self.policy.emptied()
+        return item
+
+
+class SelectableQueue(RelayQueue):
+    """A Queue that can be waited on with select() next to sockets.
+
+    A byte is written to an internal pipe whenever an item lands in an empty queue, so a consumer sleeping in
+    select() on this object wakes up immediately instead of polling.
+    """
+
+    def __init__(self, policy=None):
+        super(SelectableQueue, self).__init__(policy)
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+
+    def fileno(self):
+        return self._wakeup_r
+
+    def _put(self, item):
+        was_empty = not self._qsize()
+        super(SelectableQueue, self)._put(item)
+        if was_empty:
+            try:
+                os.write(self._wakeup_w, b'\0')
+            except BlockingIOError:
+                pass  # Pipe is full, the consumer is already due to wake up
+
+    def drain(self):
+        """Clear the wakeup pipe and return every queued item without blocking."""
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        items = []
+        while True:
+            try:
+                items.append(self.get_nowait())
+            except Empty:
+                return items
+
+
+class PolicyQueue(asyncio.Queue):
+    """An asyncio.Queue that holds relayed events under a DropPolicy."""
+
+    def __init__(self, policy):
+        super(PolicyQueue, self).__init__()
+        self.policy = policy
+
+    def _put(self, item):
+        self.policy.admit(self._queue, item)
+
+    def _get(self):
+        item = super(PolicyQueue, self)._get()
+        if not self._queue:
+            self.policy.emptied()
+        return item
+
+
+class LoopQueue:
+    """An asyncio.Queue that threads can put to.
+
+    Coroutines on `loop` await `queue.get()`; put_nowait() may be called from any thread and hands the item over to
+    the loop, which wakes only when something arrives.
+    """
+
+    def __init__(self, loop, policy=None):
+        self.loop = loop
+        self.queue = asyncio.Queue() if policy is None else PolicyQueue(policy)
+        self.policy = policy
+
+    def put_nowait(self, item):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def drain(self):
+        """Every queued item, without waiting. Only call this from the loop."""
+        items = []
+        while True:
+            try:
+                items.append(self.queue.get_nowait())
+            except asyncio.QueueEmpty:
+                return items
@@ -0,0 +1,30 @@
+from time import monotonic
+
+
+class TokenBucket:
+    """Token bucket refilling at `rate` tokens per second, holding at most `burst` tokens."""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.stamp = monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def consume(self, amount=1, now=None):
+        """Take `amount` tokens if they are available, returns whether they were taken."""
+        self._refill(monotonic() if now is None else now)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    def delay(self, amount=1, now=None):
+        """Seconds until `amount` tokens will be available."""
+        self._refill(monotonic() if now is None else now)
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.rate
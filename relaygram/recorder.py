@@ -0,0 +1,67 @@
+from threading import Lock, Timer
+import gzip
+import json
+import logging
+import time
+
+# Record kinds, each a JSON array on its own line: [kind, time, ...]
+IRC_LINE = "irc"  # [kind, time, server, raw line as received]
+TG_UPDATES = "tg"  # [kind, time, [raw update, ...] as getUpdates returned them]
+
+
+class Recorder:
+    """Captures the bridge's inbound traffic for replay: every line from the IRC servers and every batch of
+    Telegram updates, with the time it arrived. Stored as gzipped JSON lines, which a busy day keeps small. The
+    stream is flushed a second after the first record that isn't on disk yet, so a killed bridge loses no more than
+    that, and close() finishes the file.
+    """
+
+    FLUSH_INTERVAL = 1
+
+    def __init__(self, filename):
+        self.log = logging.getLogger("relaygram.recorder")
+        self.file = gzip.open(filename, 'at', encoding='utf-8')
+        self.lock = Lock()
+        self.flush_timer = None
+        self.log.info("Recording inbound traffic to {}".format(filename))
+
+    def write(self, *record):
+        line = json.dumps(record, separators=(',', ':'), ensure_ascii=False) + "\n"
+        with self.lock:
+            if self.file.closed:
+                return  # Shutting down
+            self.file.write(line)
+            if self.flush_timer is None:
+                self.flush_timer = Timer(self.FLUSH_INTERVAL, self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.flush_timer = None
+            if not self.file.closed:
+                self.file.flush()
+
+    def irc_line(self, connection, event):
+        self.write(IRC_LINE, time.time(), connection.server, event.arguments[0])
+
+    def tg_updates(self, updates):
+        if updates:
+            self.write(TG_UPDATES, time.time(), updates)
+
+    def close(self):
+        with self.lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            self.file.close()
+
+
+def read_recording(filename):
+    """The records of a recording in order, as lists."""
+    with gzip.open(filename, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                yield json.loads(line)
+        except (EOFError, ValueError):
+            return  # Cut short when the bridge was stopped, what came before is still good
@@ -0,0 +1,101 @@
+from threading import Event, Thread
+import logging
+import os
+
+import yaml
+
+SECTIONS = ('telegram', 'irc', 'media')  # Looked up per event, so swapping them in changes behaviour right away
+SERVER_KEYS = ('hostname', 'port', 'nickname', 'channels')
+
+
+class ConfigReloader:
+    """Applies edits to relaygram.yaml and channel_map.json to the running bridge, without reconnecting.
+
+    A reload is asked for with SIGHUP, or happens by itself when relaygram.reload_interval is set and either file's
+    modification time has changed. The new config is checked before any of it is used, a broken edit is logged and
+    the running config kept. The telegram, irc and media sections are then each swapped in whole in the shared
+    config dict. Handlers look their patterns and switches up from there once per event, so an event is formatted
+    either entirely the old way or entirely the new way. IRC servers are diffed against what is running: only new
+    servers are connected, only removed ones left, and only the channels that differ joined or parted.
+
+    Settings that are only read at startup, like the bot token, engine, journal, shards, rate limits and the media
+    port, still need a restart.
+    """
+
+    def __init__(self, config_dir, config, channel_map, irc, interval=0):
+        self.log = logging.getLogger("relaygram.reload")
+        self.config_file = os.path.join(config_dir, "relaygram.yaml")
+        self.config = config
+        self.channel_map = channel_map
+        self.irc = irc
+        self.interval = interval
+
+        self.requested = Event()
+        self.thread = Thread(target=self.watch_loop, daemon=True)
+
+    def run(self):
+        self.thread.start()
+        return self
+
+    def request(self):
+        """Ask for a reload, safe to call from a signal handler."""
+        self.requested.set()
+
+    def watch_loop(self):
+        mtimes = self.mtimes()
+        while True:
+            requested = self.requested.wait(self.interval or None)
+            self.requested.clear()
+            current = self.mtimes()
+            if not requested and current == mtimes:
+                continue  # Neither file changed since the last look
+            mtimes = current
+            try:
+                self.reload()
+            except Exception:
+                self.log.exception("Reload failed, keeping the running configuration")
+
+    def mtimes(self):
+        times = []
+        for filename in (self.config_file, self.channel_map.filename):
+            try:
+                times.append(os.stat(filename).st_mtime_ns)
+            except FileNotFoundError:
+                times.append(None)
+        return times
+
+    def reload(self):
+        with open(self.config_file, "r") as f:
+            config = yaml.safe_load(f)
+        self.check(config)
+        for section in ('telegram', 'irc'):
+            # Patterns are indexed directly when formatting, one gone missing would fail every event
+            missing = [key for key in self.config[section] if key.endswith('_pattern') and key not in config[section]]
+            if missing:
+                raise ValueError("{} is missing {}".format(section, ", ".join(missing)))
+
+        for section in ('relaygram', 'journal'):
+            if config.get(section) != self.config.get(section):
+                self.log.warning("Changes to the {} section need a restart".format(section))
+
+        # Connect new servers before the channel map can route to them
+        self.irc.reconfigure(config['irc']['servers'])
+        for section in SECTIONS:
+            self.config[section] = config[section]
+        self.channel_map.reload()
+        self.log.info("Reloaded configuration and channel map")
+
+    @staticmethod
+    def check(config):
+        if not isinstance(config, dict):
+            raise ValueError("Config is empty or not a mapping")
+        for section in SECTIONS:
+            if not isinstance(config.get(section), dict):
+                raise ValueError("Missing section {}".format(section))
+        servers = config['irc'].get('servers')
+        if not isinstance(servers, dict):
+            raise ValueError("Missing irc.servers")
+        for name, server_params in servers.items():
+            missing = [key for key in SERVER_KEYS if key not in (server_params or {})]
+            if missing:
+                raise ValueError("Server {} is missing {}".format(name, ", ".join(missing)))
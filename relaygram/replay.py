@@ -0,0 +1,174 @@
+from itertools import count
+from threading import Condition, Thread
+from urllib.parse import parse_qs
+import json
+import logging
+import socket
+import time
+
+import requests
+
+from relaygram.botapi import BotAPITransport
+from relaygram.recorder import IRC_LINE, TG_UPDATES, read_recording
+
+
+def stub_response(content):
+    """A requests Response carrying `content`, bytes as they are or anything else as a Bot API result."""
+    resp = requests.models.Response()
+    resp.status_code = 200
+    resp._content = content if isinstance(content, bytes) else json.dumps({'ok': True, 'result': content}).encode()
+    resp._content_consumed = True
+    return resp
+
+
+class Replayer:
+    """Plays a recording back through the bridge, `speed` times as fast as it happened.
+
+    The handlers run unchanged against local stand-ins for both networks. Each IRC server is a socketpair: the
+    bridge's end is handed to its reactor as if it had connected, the recorded lines are written into the other end
+    as they come due, and whatever the bridge sends back is read and thrown away. The Bot API is a BotAPITransport
+    that never touches the network: getUpdates hands out the recorded batches as they come due, with their dates
+    moved to now so none are too old to relay, and every other call is answered on the spot. Times are counted from
+    start(). Once everything has been played and `settle` seconds have passed for the bridge to catch up,
+    on_finished is called.
+    """
+
+    def __init__(self, filename, config, speed=1.0, on_finished=None, settle=2):
+        self.log = logging.getLogger("relaygram.replay")
+        self.speed = speed
+        self.on_finished = on_finished
+        self.settle = settle
+
+        self.irc_records, self.tg_records = [], []
+        for record in read_recording(filename):
+            if record[0] == IRC_LINE:
+                self.irc_records.append(record)
+            elif record[0] == TG_UPDATES:
+                self.tg_records.append(record)
+        times = [record[1] for record in self.irc_records[:1] + self.tg_records[:1]]
+        self.first = min(times) if times else 0
+        last = max([record[1] for record in self.irc_records[-1:] + self.tg_records[-1:]] or [self.first])
+        self.log.info("Replaying {} IRC lines and {} Telegram batches, {:.0f}s of traffic at {}x".format(
+            len(self.irc_records), len(self.tg_records), last - self.first, speed))
+
+        self.servers = {}  # hostname -> our end of its socketpair
+        self.cond = Condition()
+        self.started = None
+        self.tg_next = 0  # Index of the next Telegram batch to hand out
+        self.irc_done = False
+        self.transport = ReplayTransport(config, self)
+        self.feeder = Thread(target=self.feed_irc, daemon=True)
+
+    def start(self):
+        with self.cond:
+            self.started = time.monotonic()
+            self.cond.notify_all()
+        self.feeder.start()
+        return self
+
+    def due(self, record):
+        return self.started + (record[1] - self.first) / self.speed
+
+    def open_socket(self, address, timeout=None):
+        """Stands in for socket.create_connection when the IRC handlers connect."""
+        ours, bridge = socket.socketpair()
+        self.servers[address[0]] = ours
+        Thread(target=self.discard_output, args=(ours,), daemon=True).start()
+        return bridge
+
+    @staticmethod
+    def discard_output(sock):
+        try:
+            while sock.recv(65536):
+                pass
+        except OSError:
+            pass
+
+    def feed_irc(self):
+        unknown = set()
+        for record in self.irc_records:
+            _, _, server, line = record
+            delay = self.due(record) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            sock = self.servers.get(server)
+            if sock is None:
+                if server not in unknown:
+                    self.log.warning("Recording has lines from {}, which isn't configured".format(server))
+                    unknown.add(server)
+                continue
+            try:
+                sock.sendall((line + "\r\n").encode('utf-8'))
+            except OSError:
+                self.log.warning("{} went away, dropping its lines".format(server))
+                self.servers.pop(server, None)
+        with self.cond:
+            self.irc_done = True
+        self.check_finished()
+
+    def next_updates(self, wait):
+        """Telegram batches that are due, waiting up to `wait` seconds for the next one."""
+        deadline = time.monotonic() + wait
+        with self.cond:
+            while True:
+                if self.started is not None and self.tg_next < len(self.tg_records):
+                    record = self.tg_records[self.tg_next]
+                    if time.monotonic() >= self.due(record):
+                        self.tg_next += 1
+                        break
+                    timeout = min(deadline, self.due(record)) - time.monotonic()
+                else:
+                    timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    return []
+                self.cond.wait(timeout)
+        self.check_finished()
+
+        now = int(time.time())
+        updates = record[2]
+        for update in updates:
+            for value in update.values():
+                if isinstance(value, dict) and 'date' in value:
+                    value['date'] = now  # Otherwise message_age would throw it away
+        return updates
+
+    def check_finished(self):
+        with self.cond:
+            if not self.irc_done or self.tg_next < len(self.tg_records) or self.on_finished is None:
+                return
+            on_finished, self.on_finished = self.on_finished, None
+        elapsed = time.monotonic() - self.started
+        self.log.info("Replay done in {:.1f}s, letting the bridge catch up for {}s".format(elapsed, self.settle))
+        Thread(target=lambda: (time.sleep(self.settle), on_finished()), daemon=True).start()
+
+
+class ReplayTransport(BotAPITransport):
+    """Answers Bot API calls from a Replayer instead of sending them."""
+
+    def __init__(self, config, replayer):
+        super(ReplayTransport, self).__init__(config)
+        self.replayer = replayer
+        self.message_ids = count(1)
+
+    def send(self, method, request, poll_timeout=None):
+        with self.timed(method):
+            if method == 'getUpdates':
+                return stub_response(self.replayer.next_updates(poll_timeout or 0))
+
+            body = request.body or ""
+            body = body.decode('utf-8') if isinstance(body, bytes) else body
+            params = {key: values[0] for key, values in parse_qs(body).items()}
+            if method == 'getMe':
+                return stub_response({'id': 1, 'is_bot': True, 'first_name': "Replay", 'username': "replay_bot"})
+            elif method == 'sendMessage':
+                return stub_response({'message_id': next(self.message_ids), 'date': int(time.time()),
+                                      'chat': {'id': int(params['chat_id']), 'type': "group"},
+                                      'text': params.get('text', "")})
+            elif method == 'getFile':
+                return stub_response({'file_id': params['file_id'], 'file_size': 4096,
+                                      'file_path': "replay/{}.jpg".format(params['file_id'])})
+            return stub_response(True)
+
+    def download(self, url, timeout):
+        with self.timed('download'):
+            return stub_response(url.encode('utf-8') * (4096 // len(url) + 1))
@@ -0,0 +1,142 @@
+from collections import OrderedDict
+from threading import Lock, Thread
+from time import sleep, time
+import json
+import logging
+import os
+
+from relaygram.transcode import PNG_SUFFIX, PREVIEW_SUFFIX
+
+
+class MediaRetention:
+    """Keeps media_dir within a disk quota and a maximum age, evicting the least recently served files first.
+
+    Sizes and last access times live in memory, ordered from least to most recently served. They are seeded by a
+    single scan the first time we run and afterwards kept current by the media store (new files) and the HTTP server
+    (every file served), then saved to media_access.json. Each pass only looks at the head of that order, so the
+    cost is proportional to what gets evicted rather than to the size of the directory. An original takes the
+    transcoder's variants of it along. Evicted names are remembered so the HTTP server can answer 410 Gone for them.
+    """
+
+    BATCH_SIZE = 256  # Most files evicted per pass
+    MAX_TOMBSTONES = 100000
+
+    def __init__(self, config, on_evict=None):
+        self.log = logging.getLogger("relaygram.retention")
+        self.media_dir = config['media_dir']
+        self.filename = os.path.join(config['config_dir'], "media_access.json")
+        self.on_evict = on_evict
+
+        self.max_bytes = config['media'].get('max_size_mb', 0) * 1024 * 1024
+        self.max_age = config['media'].get('max_age_days', 0) * 24 * 60 * 60
+        self.interval = config['media'].get('retention_interval', 60)
+
+        self.lock = Lock()
+        self.files = OrderedDict()  # filename -> [size, last access], least recently served first
+        self.evicted = OrderedDict()  # filename -> eviction time
+        self.total_bytes = 0
+        self.dirty = False
+
+        self.reload()
+
+        self.thread = Thread(target=self.main_loop, daemon=True)
+
+    def run(self):
+        self.thread.start()
+        return self
+
+    def reload(self):
+        try:
+            with open(self.filename, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {'files': self.scan(), 'evicted': {}}
+            self.dirty = True
+
+        for filename, (size, accessed) in sorted(data['files'].items(), key=lambda item: item[1][1]):
+            self.files[filename] = [size, accessed]
+            self.total_bytes += size
+        self.evicted.update(sorted(data['evicted'].items(), key=lambda item: item[1]))
+
+    def scan(self):
+        # Only done once, to adopt files that were stored before retention was tracked
+        files = {}
+        for entry in os.scandir(self.media_dir):
+            if entry.is_file() and not entry.name.endswith(".part"):
+                stat = entry.stat()
+                files[entry.name] = [stat.st_size, stat.st_mtime]
+        return files
+
+    def save(self):
+        with self.lock:
+            data = {'files': dict(self.files), 'evicted': dict(self.evicted)}
+            self.dirty = False
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_filename, self.filename)
+
+    def added(self, filename, size):
+        with self.lock:
+            old = self.files.pop(filename, None)
+            if old is not None:
+                self.total_bytes -= old[0]
+            self.files[filename] = [size, time()]
+            self.total_bytes += size
+            self.evicted.pop(filename, None)
+            self.dirty = True
+
+    def touch(self, filename):
+        with self.lock:
+            entry = self.files.get(filename)
+            if entry is not None:
+                entry[1] = time()
+                self.files.move_to_end(filename)
+                self.dirty = True
+
+    def is_evicted(self, filename):
+        return filename in self.evicted
+
+    def main_loop(self):
+        while True:
+            sleep(self.interval)
+            try:
+                while self.evict() >= self.BATCH_SIZE:
+                    pass  # Keep going in batches until we are back under the limits
+                if self.dirty:
+                    self.save()
+            except Exception:
+                self.log.exception("Media retention pass failed")
+
+    def evict(self):
+        """Evict about BATCH_SIZE files that are over the limits, with their variants, returns how many were evicted."""
+        now = time()
+        victims = []
+        with self.lock:
+            while self.files and len(victims) < self.BATCH_SIZE:
+                filename, (size, accessed) = next(iter(self.files.items()))
+                if not (self.max_bytes and self.total_bytes > self.max_bytes) and not (self.max_age and now - accessed > self.max_age):
+                    break
+                # Variants go with their original, they would otherwise be served for its URL after it's gone
+                for name in [filename] + [filename + suffix for suffix in (PNG_SUFFIX, PREVIEW_SUFFIX)]:
+                    entry = self.files.pop(name, None)
+                    if entry is not None:
+                        self.total_bytes -= entry[0]
+                        self.evicted[name] = now
+                        victims.append(name)
+
+            while len(self.evicted) > self.MAX_TOMBSTONES:
+                self.evicted.popitem(last=False)
+            if victims:
+                self.dirty = True
+
+        for filename in victims:
+            try:
+                os.remove(os.path.join(self.media_dir, filename))
+            except FileNotFoundError:
+                pass
+        if victims:
+            self.log.info("Evicted {} media files, {} bytes in use".format(len(victims), self.total_bytes))
+            if self.on_evict:
+                self.on_evict(victims)
+        return len(victims)
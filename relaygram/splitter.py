@@ -0,0 +1,55 @@
+import re
+
+WORDS_RE = re.compile(r'(\s+)')
+
+
+def split_bytes(word, budget, first_budget=None):
+    """Cut a word into pieces of at most `budget` UTF-8 bytes (`first_budget` for the first), never inside a character."""
+    data = word.encode('utf-8')
+    pieces = []
+    limit = budget if first_budget is None else first_budget
+    while len(data) > limit:
+        cut = limit
+        while cut and data[cut] & 0xc0 == 0x80:  # Continuation byte, back up to the start of its character
+            cut -= 1
+        pieces.append(data[:cut].decode('utf-8'))
+        data = data[cut:]
+        limit = budget
+    pieces.append(data.decode('utf-8'))
+    return pieces
+
+
+def split_message(text, budget):
+    """Split text into IRC lines of at most `budget` UTF-8 bytes each.
+
+    Every line of the text starts a new IRC line and blank ones are dropped. Long lines are broken between words,
+    only words that don't fit on a line of their own are cut.
+    """
+    lines = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        if len(line) <= budget // 4 or len(line.encode('utf-8')) <= budget:  # Fits, the common case
+            lines.append(line)
+            continue
+
+        current, size = "", 0
+        for token in WORDS_RE.split(line):
+            token_size = len(token.encode('utf-8'))
+            if size + token_size <= budget:
+                current += token
+                size += token_size
+                continue
+            if token_size > budget:
+                # Has to be cut anyway, so start it on this line rather than leaving the rest of the line empty
+                pieces = split_bytes(token, budget, budget - size)
+                pieces[0] = current + pieces[0]
+            elif token.isspace():
+                pieces = [current, ""]  # Dropped at the break
+            else:
+                pieces = [current, token]
+            lines.extend(piece.rstrip() for piece in pieces[:-1] if piece.strip())
+            current, size = pieces[-1], len(pieces[-1].encode('utf-8'))
+        if current.strip():
+            lines.append(current.rstrip())
+    return lines
@@ -1,14 +1,15 @@
-import os
 from queue import Empty
-from . import events
+from . import events, metrics
+from .botapi import BotAPITransport
+from .media import MediaPipeline
+from .message_index import MessageIndex
+from .mentions import MentionMatcher
+from .telegram_sender import TelegramSender, HIGH, LOW
 from time import sleep
 import twx.botapi
 from threading import Thread
-import random
-import string
 import logging
-import mimetypes
-import re
+import os
 import time
 
 class ConfigError(Exception):
@@ -16,64 +17,163 @@ class ConfigError(Exception):
 
 
 class TelegramHandler:
-    def __init__(self, channel_map, config, my_queue, out_queues):
+    def __init__(self, channel_map, config, my_queue, out_queues, media_store, journal=None, transport=None):
         self.log = logging.getLogger("relaygram.telegram")
         self.channel_map = channel_map
         self.config = config
         self.my_queue = my_queue
         self.out_queues = out_queues
+        self.journal = journal
         self.connect_request = {}
-        self.seen_usernames = set()
+        self.mentions = MentionMatcher(self.config['telegram'].get('mention_cache_size', 1000))
+
+        # Setup Telegram bot, its calls go over pooled keep-alive connections
+        self.transport = transport if transport is not None else BotAPITransport(self.config)
+        self.transport.install()
+        api_url = self.config['telegram'].get('api_url')
+        if api_url:  # A self-hosted Bot API server, or a local stand-in for testing
+            twx.botapi.TelegramBotRPCRequest.api_url_base = api_url.rstrip('/') + '/bot'
+            twx.botapi.TelegramDownloadRequest.download_url_base = api_url.rstrip('/') + '/file/bot'
 
-        # Setup Telegram bot
         try:
             self.twx = twx.botapi.TelegramBot(token=self.config['relaygram']['bot_token'])
-            self.twx.update_bot_info().wait()  # Make sure we know who we are
+            self.started = time.time()
+            self.bot_info = self.twx.update_bot_info()  # Runs while the rest starts, polling waits for it
         except KeyError:
             raise ConfigError("Error in configuration file, cannot find bot token.")
 
-        self.thread = Thread(target=self.main_loop)
+        # Who each message we relay was from, to attribute replies to it
+        index_file = None
+        if self.config['telegram'].get('persist_message_index', False):
+            index_file = os.path.join(self.config['config_dir'], "message_index.json")
+        self.message_index = MessageIndex(self.config['telegram'].get('message_index_size', 10000), index_file)
+        self.sender = TelegramSender(self.twx, self.config, self.message_index)
+        self.max_backlog = self.config['telegram'].get('max_backlog', 1000)
+        metrics.QUEUE_DEPTH.set_function(self.my_queue.qsize, queue="telegram")
+        metrics.QUEUE_DEPTH.set_function(self.sender.backlog, queue="telegram_sender")
+        self.media = MediaPipeline(self.twx, self.config, media_store, self.relay, self.transport, self.journal)
+
+        self.poll_thread = Thread(target=self.poll_loop)
+        self.send_thread = Thread(target=self.send_loop)
 
     def run(self):
-        self.thread.start()
+        self.poll_thread.start()
+        self.send_thread.start()
         return self
 
-    def main_loop(self):
-        last_update = 0
+    def poll_loop(self):
+        # Long-poll: Telegram holds the request open until an update arrives or poll_timeout passes
+        self.identify()
+        self.media.resume()
+        offset = self.journal.offset if self.journal is not None else 0
+        poll_timeout = self.config['telegram'].get('poll_timeout', 30)
+        while True:
+            updates = self.twx.get_updates(offset, timeout=poll_timeout).wait()
+            if updates is None or isinstance(updates, twx.botapi.Error):
+                self.log.error("Failed to fetch telegram updates: {}".format(updates and updates.description))
+                sleep(self.config['telegram'].get('poll_retry', 5))
+                continue
+            offset = self.process_updates(updates, offset)
+
+    def identify(self):
+        """Wait until we know who we are, updates are checked against it. Blocks, asking again until getMe works."""
         while True:
-            # Process Telegram Events
+            result = self.bot_info.wait(self.config['telegram'].get('connect_timeout', 30))
+            if result is not None and not isinstance(result, twx.botapi.Error):
+                break
+            self.log.error("Failed to fetch bot info: {}".format(result.description if result else "no response"))
+            sleep(self.config['telegram'].get('poll_retry', 5))
+            self.bot_info = self.twx.update_bot_info()
+        self.log.info("Telegram ready as @{} in {:.2f}s".format(result.username, time.time() - self.started))
+
+    def process_updates(self, updates, offset):
+        """Handle a batch from getUpdates, returns the offset to poll from next."""
+        for update in updates:
+            offset = update.update_id + 1
             try:
-                updates = self.twx.get_updates(last_update).wait()
-                if updates:
-                    for update in updates:
-                        last_update = update.update_id+1
-                        self.process_tg_msg(update)
-                self.process_queue_once()
-            except:
-                pass
-            sleep(.1)
-
-    def process_queue_once(self):
-        try:
-            self.process_event(self.my_queue.get_nowait())
+                self.process_tg_msg(update)
+            except Exception:
+                self.log.exception("Failed to process telegram update {}".format(update.update_id))
+
+        if self.journal is not None:
+            self.journal.set_offset(offset)  # So a restart doesn't fetch these again
+            self.journal.sync()  # Held media too: the next getUpdates confirms these to Telegram
+        return offset
+
+    def send_loop(self):
+        send_delay = None
+        while True:
+            if self.accepting():
+                self.process_batch(self.next_batch(send_delay))
+            else:
+                sleep(send_delay or 0)  # Backed up, leave events to the bounded queue
+            send_delay = self.sender.pump()
+
+    def accepting(self):
+        """Whether to take more events, or leave them queued until the sender has caught up. Only chats that can send
+        count, one that is paused or over its budget mustn't hold up the rest."""
+        return not self.max_backlog or self.sender.ready() < self.max_backlog
 
+    def process_batch(self, batch):
+        for event in batch:
+            try:
+                self.process_event(event)
+            except Exception:
+                self.log.exception("Failed to relay event to telegram: {}".format(event))
+                metrics.EVENTS_DROPPED.inc(network="telegram", reason="error")
+                self.ack(event)  # Don't replay it after a restart just to fail again
+
+    def next_batch(self, timeout=None):
+        # Block until there is work or the sender can go again, then take everything else that is waiting
+        try:
+            batch = [self.my_queue.get(timeout=timeout)]
+        except Empty:
+            return []
+        try:
+            while True:
+                batch.append(self.my_queue.get_nowait())
         except Empty:
-            pass  # Don't Care
+            return batch
 
-    def add_mentions(self, msg):
+    def add_mentions(self, chat_id, msg):
         if self.config['telegram']['convert_mentions']:
-            for username in self.seen_usernames:
-                msg = re.sub(r'\b' + re.escape(username) + r'\b', "@{}".format(username), msg, flags=re.I)
+            msg = self.mentions.convert(chat_id, msg)
         return msg
 
     def process_event(self, event):
-        dest = self.channel_map.get_dest("irc", "{}:{}".format(event.src[0], event.src[1]))
+        messages = [(dest, self.format_event(dest, event)) for dest in self.channel_map.route(event.src)]
+        messages = [(dest, msg) for dest, msg in messages if msg]
+        if not messages:
+            self.ack(event)
+            return
+
+        unsent = [len(messages)]
+
+        def sent():
+            if event.ts is not None:
+                metrics.RELAY_LATENCY.observe(max(0, time.time() - event.ts), direction="irc_to_telegram")
+            unsent[0] -= 1
+            if not unsent[0]:
+                self.ack(event)
+
+        priority = LOW if event.type in (events.Join, events.Part, events.Summary) else HIGH
+        origin = (event.user, event.src) if event.type in (events.Message, events.Action) else None
+        for dest, msg in messages:
+            self.log.info("Sending to telegram: {msg}".format(msg=msg))
+            self.sender.queue(dest, msg, priority, on_sent=sent, origin=origin)
+
+    def ack(self, event):
+        # Tell the journal this event has been delivered
+        if self.journal is not None and event.seq is not None:
+            self.journal.ack("tg", event.seq)
+
+    def format_event(self, dest, event):
         tgconfig = self.config['telegram']
 
         msg = None
 
         if event.type is events.Message:
-            msg = tgconfig['message_pattern'].format(nick=event.user, msg=self.add_mentions(event.msg))
+            msg = tgconfig['message_pattern'].format(nick=event.user, msg=self.add_mentions(dest, event.msg))
         elif event.type is events.Join:
             if self.config['telegram']['send_join']:
                 msg = tgconfig['join_pattern'].format(nick=event.user, msg=event.msg)
@@ -87,13 +187,14 @@ class TelegramHandler:
             if self.config['telegram']['send_topic']:
                 msg = tgconfig['topic_pattern'].format(nick=event.user, msg=event.msg)
         elif event.type is events.Action:
-            msg = tgconfig['action_pattern'].format(nick=event.user, msg=self.add_mentions(event.msg))
+            msg = tgconfig['action_pattern'].format(nick=event.user, msg=self.add_mentions(dest, event.msg))
+        elif event.type is events.Summary:
+            if self.config['telegram']['send_join'] or self.config['telegram']['send_part']:
+                msg = tgconfig.get('summary_pattern', "** {msg}").format(msg=event.msg)
         else:
             msg = None
 
-        if msg:
-            self.log.info("Sending to telegram: {msg}".format(msg=msg))
-            self.twx.send_message(dest, msg)
+        return msg
 
     @staticmethod
     def build_keyboard(buttons):
@@ -115,12 +216,12 @@ class TelegramHandler:
 
     def process_tg_msg(self, update):
         if update.message:
-            if self.channel_map.get_dest("tg", update.message.chat.id) is None:
+            if not self.channel_map.route(("tg", update.message.chat.id)):
                 self.process_mapping(update)
             else:
                 message = update.message
                 user = update.message.sender.username
-                self.seen_usernames.add(user)
+                self.mentions.seen(message.chat.id, user)
 
                 if (time.time() - message.date) > self.config['telegram']['message_age']:
                     return # Message too old
@@ -133,87 +234,39 @@ class TelegramHandler:
                     if sender.id != self.twx.id:
                         reply_prefix = self.config['telegram']['reply_prefix'].format(nick=(sender.username or "{} {}".format(sender.first_name, sender.last_name)))
                     else:
-                        try:
-                            # TODO: Changing display patterns will break this, figure out how to make it dynamic. (Maybe just configure the regex)
-                            nick = re.match(r'<(.*?)>', message.reply_to_message.text).group(1)
-                            reply_prefix = self.config['telegram']['reply_prefix'].format(nick=nick)
-                        except (IndexError, AttributeError):  # If there's a problem just don't reply.
-                            reply_prefix = ''
+                        # One of ours, relayed from IRC. If it has been forgotten just don't reply.
+                        origin = self.message_index.lookup(message.chat.id, message.reply_to_message.message_id)
+                        if origin is not None:
+                            reply_prefix = self.config['telegram']['reply_prefix'].format(nick=origin[0])
+
+                caption = " {}".format(message.caption) if message.caption else ""
+                item = None  # Media is relayed by the media pipeline once it has been downloaded
 
                 if message.photo:
-                    file = self.twx.get_file(message.photo[-1].file_id).join().result
-                    filename = self.store_telegram_media(file)
-                    mimetype = mimetypes.guess_type(filename)[0]
-                    file_size = self.sizeof_fmt(message.photo[-1].file_size)
-
-                    msg = "{reply_prefix}[{mime}] {url} [{width}x{height}] [{file_size}]".format(reply_prefix=reply_prefix, mime=mimetype, url=self.config['media']['base_url'] + filename,
-                                                                                   width=message.photo[-1].width, height=message.photo[-1].height, file_size=file_size)
-                    if message.caption:
-                        msg = "{msg} {caption}".format(msg=msg, caption=message.caption)
-                    item = events.Message(src=src, user=user, msg=msg)
+                    photo = message.photo[-1]
+                    self.relay_media(src, user, photo, "{reply_prefix}[{mime}] {url} [{width}x{height}] [{file_size}]{caption}",
+                                     reply_prefix=reply_prefix, width=photo.width, height=photo.height, caption=caption)
 
                 elif message.audio:
-                    file = self.twx.get_file(message.audio.file_id).join().result
-                    filename = self.store_telegram_media(file)
-                    mimetype = mimetypes.guess_type(filename)[0]
-                    file_size = self.sizeof_fmt(message.audio.file_size)
-
-                    duration = self.time_fmt(message.audio.duration)
-
-                    msg = "{reply_prefix}[{mime}] {url} [{duration}] [{file_size}]".format(reply_prefix=reply_prefix, mime=mimetype, url=self.config['media']['base_url'] + filename,
-                                                                            duration=duration, file_size=file_size)
-                    item = events.Message(src=src, user=user, msg=msg)
+                    self.relay_media(src, user, message.audio, "{reply_prefix}[{mime}] {url} [{duration}] [{file_size}]",
+                                     reply_prefix=reply_prefix, duration=self.time_fmt(message.audio.duration))
 
                 elif message.sticker:
-                    file = self.twx.get_file(message.sticker.file_id).join().result
-                    filename = self.store_telegram_media(file)
-                    mimetype = mimetypes.guess_type(filename)[0]
-                    file_size = self.sizeof_fmt(message.sticker.file_size)
-
-                    msg = "{reply_prefix}[sticker] {url} [{width}x{height}] [{file_size}]".format(reply_prefix=reply_prefix, mime=mimetype, url=self.config['media']['base_url'] + filename,
-                                                                                   width=message.sticker.width, height=message.sticker.height, file_size=file_size)
-                    item = events.Message(src=src, user=user, msg=msg)
+                    self.relay_media(src, user, message.sticker, "{reply_prefix}[sticker] {url} [{width}x{height}] [{file_size}]",
+                                     reply_prefix=reply_prefix, width=message.sticker.width, height=message.sticker.height)
 
                 elif message.video:
-                    file = self.twx.get_file(message.video.file_id).join().result
-                    filename = self.store_telegram_media(file)
-                    mimetype = mimetypes.guess_type(filename)[0]
-                    file_size = self.sizeof_fmt(message.video.file_size)
-
-                    duration = self.time_fmt(message.video.duration)
-
-                    msg = "{reply_prefix}[{mime}] {url} [{width}x{height}] [{duration}] [{file_size}]".format(reply_prefix=reply_prefix, mime=mimetype, url=self.config['media']['base_url'] + filename,
-                                                                                               duration=duration, width=message.video.width, height=message.video.height,
-                                                                                               file_size=file_size)
-                    if message.caption:
-                        msg = "{msg} {caption}".format(msg=msg, caption=message.caption)
-
-                    item = events.Message(src=src, user=user, msg=msg)
+                    self.relay_media(src, user, message.video, "{reply_prefix}[{mime}] {url} [{width}x{height}] [{duration}] [{file_size}]{caption}",
+                                     reply_prefix=reply_prefix, width=message.video.width, height=message.video.height,
+                                     duration=self.time_fmt(message.video.duration), caption=caption)
 
                 elif message.voice:
-                    file = self.twx.get_file(message.voice.file_id).join().result
-                    filename = self.store_telegram_media(file)
-                    mimetype = mimetypes.guess_type(filename)[0]
-                    file_size = self.sizeof_fmt(message.voice.file_size)
-
-                    duration = self.time_fmt(message.voice.duration)
-
-                    msg = "{reply_prefix}[voice msg] {url} [{duration}] [{file_size}]".format(reply_prefix=reply_prefix, mime=mimetype, url=self.config['media']['base_url'] + filename,
-                                                                                duration=duration, file_size=file_size)
-                    item = events.Message(src=src, user=user, msg=msg)
+                    self.relay_media(src, user, message.voice, "{reply_prefix}[voice msg] {url} [{duration}] [{file_size}]",
+                                     reply_prefix=reply_prefix, duration=self.time_fmt(message.voice.duration))
 
                 elif message.document:
-                    file = self.twx.get_file(message.document.file_id).join().result
-                    filename = self.store_telegram_media(file)
-                    mimetype = mimetypes.guess_type(filename)[0]
-                    file_size = self.sizeof_fmt(message.document.file_size)
-
-                    size = message.document.file_size
-
-                    msg = "{reply_prefix}[{mime}] {url} [{file_size}]".format(reply_prefix=reply_prefix, mime=mimetype, url=self.config['media']['base_url'] + filename,
-                                                               file_size=file_size)
-
-                    item = events.Message(src=src, user=user, msg=msg)
+                    self.relay_media(src, user, message.document, "{reply_prefix}[{mime}] {url} [{file_size}]",
+                                     reply_prefix=reply_prefix)
 
                 elif message.contact:
                     if message.contact.last_name:
@@ -241,7 +294,17 @@ class TelegramHandler:
                     # Plain message
                     item = events.Message(src=src, user=user, msg="{reply_prefix}{msg}".format(reply_prefix=reply_prefix, msg=message.text))
 
-                [queue.put_nowait(item) for queue in self.out_queues]
+                if item is not None:
+                    item = item._replace(ts=time.time())  # Stamped on arrival, for the relay latency metric
+                    self.media.emit(message.chat.id, item)  # Keeps it behind any media still downloading for this chat
+
+    def relay_media(self, src, user, media, pattern, **fields):
+        # Download in the background, the message is relayed once the file is stored and has a URL
+        item = events.Message(src=src, user=user, msg=None)._replace(ts=time.time())
+        self.media.submit(src[1], media, item, pattern, file_size=self.sizeof_fmt(media.file_size or 0), **fields)
+
+    def relay(self, item):
+        [queue.put_nowait(item) for queue in self.out_queues]
 
     @staticmethod
     def time_fmt(runtime):
@@ -258,19 +321,6 @@ class TelegramHandler:
             num /= 1024.0
         return "%.1f%s%s" % (num, 'Yi', suffix)
 
-    def store_telegram_media(self, file):
-        if 'randomize_name_length' in self.config['media'] and self.config['media']['randomize_name_length'] > 0:
-            file_basename = "".join(random.choice(string.ascii_letters + string.digits) for _ in range(self.config['media']['randomize_name_length']))
-        else:
-            file_basename = "".join(random.choice(string.ascii_letters + string.digits) for _ in range(8))
-
-        ext = os.path.splitext(file.file_path)[1]
-        filename = file_basename + ext
-        out_file = os.path.join(self.config['media_dir'], filename)
-        self.twx.download_file(file_path=file.file_path, out_file=open(out_file, 'wb'))
-
-        return filename
-
     def process_mapping(self, update):
         if update.message.reply_to_message and update.message.reply_to_message.message_id in self.connect_request:
             try:
@@ -280,7 +330,7 @@ class TelegramHandler:
             except ValueError:
                 print("Bad choice, could not connect channels")
             server_host = self.config["irc"]["servers"][server_name]["hostname"]
-            self.channel_map.set_mapping(update.message.chat.id, "{}:{}".format(server_host, channel_name))
+            self.channel_map.add_mapping(update.message.chat.id, server_host, channel_name)
             print("Connect to {}:{}".format(server_name, channel_name))
         else:
             channels = []
@@ -0,0 +1,147 @@
+from collections import OrderedDict, deque
+from time import monotonic
+import logging
+import re
+
+import twx.botapi
+
+from relaygram import metrics
+from relaygram.ratelimit import TokenBucket
+
+HIGH, LOW = 0, 1  # Chat messages go before join/part notices
+
+RETRY_AFTER_RE = re.compile(r'retry after (\d+)', re.I)
+
+
+class TelegramSender:
+    """Rate limited outbound sendMessage scheduler.
+
+    Sends are paced by a global token bucket and one per chat, matching Telegram's limits of roughly 30 messages a
+    second overall and 20 a minute in a group. When a chat has more lines waiting than it has budget for, consecutive
+    lines are merged into a single message of up to 4096 characters. A 429 pauses the chat for the retry_after
+    Telegram asks for and the lines are sent later instead of being dropped. pump() never waits, it returns how long
+    until something can be sent so the caller can block on its queue for that long. Each message that goes out is
+    recorded in `index`, when given, under the origin of its first line.
+
+    A chat holds at most max_backlog lines. When it is full, its oldest join/part notice makes room, then a newcomer
+    notice is dropped, and only then its oldest message. Dropped lines count as sent for on_sent.
+    """
+
+    MAX_LENGTH = 4096
+    RETRY_DELAY = 5  # When Telegram couldn't be reached at all
+
+    def __init__(self, twx_bot, config, index=None):
+        self.log = logging.getLogger("relaygram.telegram")
+        self.twx = twx_bot
+        self.index = index
+
+        tgconfig = config['telegram']
+        self.global_bucket = TokenBucket(tgconfig.get('rate_global', 30), tgconfig.get('rate_global', 30))
+        self.chat_rate = tgconfig.get('rate_per_chat', 20) / 60.0
+        self.chat_burst = tgconfig.get('burst_per_chat', 5)
+        self.max_backlog = tgconfig.get('max_backlog', 1000)
+
+        self.chats = OrderedDict()  # chat id -> (high priority deque, low priority deque), in round-robin order
+        self.buckets = {}
+        self.blocked_until = {}
+
+    def queue(self, chat_id, text, priority=HIGH, on_sent=None, origin=None):
+        """Queue text for a chat, on_sent is called once all of it has been delivered (or given up on). origin is the
+        (nick, (server, channel)) to index the message under."""
+        high, low = self.chats.setdefault(chat_id, (deque(), deque()))
+        pending = (high, low)[priority]
+        chunks = [text[i:i + self.MAX_LENGTH] for i in range(0, len(text), self.MAX_LENGTH)]
+        while self.max_backlog and len(high) + len(low) + len(chunks) > self.max_backlog:
+            if not low and priority == LOW:
+                self.dropped([on_sent] if on_sent else [])
+                return
+            if not (high or low):
+                break  # Longer than the whole backlog on its own, let it through
+            self.dropped((low or high).popleft()[1])
+        for chunk in chunks[:-1]:
+            pending.append((chunk, [], origin))
+        pending.append((chunks[-1], [on_sent] if on_sent else [], origin))
+
+    def backlog(self):
+        """Messages waiting to be sent, across all chats."""
+        return sum(len(high) + len(low) for high, low in list(self.chats.values()))
+
+    def ready(self):
+        """Messages waiting in chats that may send right now. Those paused by a 429 or out of their own budget wait on
+        their chat alone, and are left out."""
+        now = monotonic()
+        ready = 0
+        for chat_id, (high, low) in list(self.chats.items()):
+            bucket = self.buckets.get(chat_id)
+            if self.blocked_until.get(chat_id, 0) <= now and (bucket is None or not bucket.delay(now=now)):
+                ready += len(high) + len(low)
+        return ready
+
+    @staticmethod
+    def dropped(callbacks):
+        metrics.EVENTS_DROPPED.inc(network="telegram", reason="overflow")
+        for callback in callbacks:
+            callback()
+
+    def bucket(self, chat_id):
+        if chat_id not in self.buckets:
+            self.buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return self.buckets[chat_id]
+
+    def pump(self):
+        """Send what the rate limits allow, returns seconds until the next send is possible or None when idle."""
+        while self.chats:
+            delays, sent = [], False
+            for chat_id in list(self.chats):
+                bucket = self.bucket(chat_id)
+                wait = max(self.blocked_until.get(chat_id, 0) - monotonic(), bucket.delay())
+                if wait > 0:
+                    delays.append(wait)
+                    continue
+
+                if not self.global_bucket.consume():
+                    return self.global_bucket.delay()
+                bucket.consume()
+
+                high, low = self.chats.pop(chat_id)
+                self.send(chat_id, high if high else low, bucket)
+                if high or low:
+                    self.chats[chat_id] = (high, low)  # Back of the line
+                sent = True
+
+            if not sent:
+                return min(delays)
+        return None
+
+    def send(self, chat_id, pending, bucket):
+        text, callbacks, origin = pending.popleft()
+        # Over budget: fold the lines that would otherwise have to wait into this message
+        merged = [(text, callbacks, origin)]
+        while pending and len(pending) > bucket.tokens and len(text) + 1 + len(pending[0][0]) <= self.MAX_LENGTH:
+            next_text, next_callbacks, next_origin = pending.popleft()
+            merged.append((next_text, next_callbacks, next_origin))
+            text = text + "\n" + next_text
+            callbacks = callbacks + next_callbacks
+            origin = origin or next_origin
+
+        result = self.twx.send_message(chat_id, text).wait()
+        if result is None or (isinstance(result, twx.botapi.Error) and result.error_code == 429):
+            retry = RETRY_AFTER_RE.search(result.description or "") if result is not None else None
+            retry_after = int(retry.group(1)) if retry else self.RETRY_DELAY
+            self.log.warning("Telegram send to {} failed, retrying in {}s".format(chat_id, retry_after))
+            metrics.SEND_RETRIES.inc(network="telegram")
+            self.blocked_until[chat_id] = monotonic() + retry_after
+            pending.extendleft(reversed(merged))
+            return None
+
+        if isinstance(result, twx.botapi.Error):
+            self.log.error("Failed to send to telegram: {}".format(result.description))
+            metrics.EVENTS_DROPPED.inc(len(merged), network="telegram", reason="rejected")
+        else:
+            metrics.MESSAGES_SENT.inc(network="telegram")
+            if self.index is not None and origin is not None:
+                self.index.add(chat_id, result.message_id, *origin)
+
+        for callback in callbacks:
+            callback()
+        return result
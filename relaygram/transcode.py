@@ -0,0 +1,91 @@
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import os
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+# Variants are stored next to the original as <original name><suffix>
+PNG_SUFFIX = ".png"  # For webp stickers, which many IRC clients can't preview
+PREVIEW_SUFFIX = ".preview.jpg"  # Reduced size copy of a large image
+
+
+def save_atomic(image, out_file, *args, **kwargs):
+    tmp_file = out_file + ".part"
+    image.save(tmp_file, *args, **kwargs)
+    os.replace(tmp_file, out_file)
+
+
+def make_variants(path, preview_size, preview_quality):
+    """Write the variants of the image at `path`, returns [(filename, size)] of those made. Runs in a worker process."""
+    made = []
+    with Image.open(path) as image:
+        image.load()
+        if getattr(image, 'is_animated', False):
+            return made  # Animated webp has no single frame worth showing
+
+        if path.lower().endswith('.webp'):
+            save_atomic(image, path + PNG_SUFFIX, 'PNG', optimize=True)
+            made.append(path + PNG_SUFFIX)
+
+        if max(image.size) > preview_size:
+            preview = image.convert('RGBA') if image.mode in ('P', 'LA') else image
+            if preview.mode == 'RGBA':  # JPEG has no alpha, flatten onto white
+                background = Image.new('RGB', preview.size, (255, 255, 255))
+                background.paste(preview, mask=preview.split()[3])
+                preview = background
+            preview = preview.convert('RGB')
+            preview.thumbnail((preview_size, preview_size))
+            save_atomic(preview, path + PREVIEW_SUFFIX, 'JPEG', quality=preview_quality, optimize=True)
+            if os.path.getsize(path + PREVIEW_SUFFIX) < os.path.getsize(path):
+                made.append(path + PREVIEW_SUFFIX)
+            else:
+                os.remove(path + PREVIEW_SUFFIX)  # Not worth having
+
+    return [(os.path.basename(variant), os.path.getsize(variant)) for variant in made]
+
+
+class Transcoder:
+    """Makes smaller and more widely viewable copies of downloaded images, in a pool of worker processes.
+
+    Runs after a download has been stored, so relaying never waits for it, and in other processes, so the image work
+    doesn't hold the GIL against the relay threads. The HTTP server picks which variant to serve. Needs Pillow, and
+    stays off without it.
+    """
+
+    def __init__(self, config, retention):
+        self.log = logging.getLogger("relaygram.transcode")
+        self.media_dir = config['media_dir']
+        self.retention = retention
+
+        media_config = config['media']
+        self.preview_size = media_config.get('preview_size', 1280)
+        self.preview_quality = media_config.get('preview_quality', 80)
+        self.executor = None
+        if media_config.get('transcode', False):
+            if Image is None:
+                self.log.warning("Media transcoding needs Pillow, which is not installed")
+            else:
+                self.executor = ProcessPoolExecutor(max_workers=media_config.get('transcode_workers', 2))
+
+    def submit(self, filename):
+        if self.executor is None or not filename.lower().endswith(IMAGE_EXTENSIONS):
+            return
+        path = os.path.join(self.media_dir, filename)
+        if os.path.exists(path + PNG_SUFFIX) or os.path.exists(path + PREVIEW_SUFFIX):
+            return  # A repeat of a file we already did
+        future = self.executor.submit(make_variants, path, self.preview_size, self.preview_quality)
+        future.add_done_callback(lambda future: self.done(filename, future))
+
+    def done(self, filename, future):
+        try:
+            variants = future.result()
+        except Exception:
+            self.log.exception("Failed to transcode {}".format(filename))
+            return
+        for variant, size in variants:
+            self.retention.added(variant, size)
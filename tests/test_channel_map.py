@@ -0,0 +1,24 @@
+import json
+import os
+import tempfile
+import unittest
+
+from relaygram.channel_map import ChannelMap
+
+
+class ChannelMapTest(unittest.TestCase):
+    def test_reload_keeps_unsaved_mapping(self):
+        filename = os.path.join(tempfile.mkdtemp(), "channel_map.json")
+        channel_map = ChannelMap(filename, save_delay=60)
+        channel_map.add_mapping(-100, "irc.test", "#chan")  # Not written for another minute
+
+        channel_map.reload()
+
+        self.assertEqual(channel_map.route(("tg", -100)), (("irc.test", "#chan"),))
+        with open(filename) as f:
+            self.assertEqual(json.load(f)['irc'], {"irc.test:#chan": ["-100"]})
+        self.assertIsNone(channel_map.save_timer)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+from threading import Thread
+from time import sleep, time
+import http.client
+import os
+import tempfile
+import unittest
+
+from relaygram.http_server import HTTPHandler, ThreadingHTTPServer
+from relaygram.retention import MediaRetention
+
+
+class HTTPServerTest(unittest.TestCase):
+    def setUp(self):
+        self.media_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.media_dir, "file.txt"), 'wb') as f:
+            f.write(b"0123456789")
+        self.serve()
+
+    def serve(self, retention=None):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), HTTPHandler.make_http_handler(self.media_dir, retention))
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def request(self, method, path, headers=None):
+        connection = http.client.HTTPConnection('127.0.0.1', self.httpd.server_address[1], timeout=5)
+        connection.request(method, path, headers=headers or {})
+        response = connection.getresponse()
+        body = response.read()
+        connection.close()
+        return response, body
+
+    def test_suffix_range(self):
+        response, body = self.request('GET', '/file.txt', {'Range': 'bytes=-3'})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(response.getheader('Content-Range'), 'bytes 7-9/10')
+        self.assertEqual(body, b"789")
+
+    def test_empty_suffix_range_is_unsatisfiable(self):
+        response, body = self.request('GET', '/file.txt', {'Range': 'bytes=-0'})
+        self.assertEqual(response.status, 416)
+        self.assertEqual(response.getheader('Content-Range'), 'bytes */10')
+
+    def test_head_metrics(self):
+        response, body = self.request('HEAD', '/metrics')
+        self.assertEqual(response.status, 200)
+        self.assertGreater(int(response.getheader('Content-Length')), 0)
+        self.assertEqual(body, b"")
+
+    @staticmethod
+    def wait_touched(retention, filename):
+        deadline = time() + 5
+        while list(retention.files)[-1] != filename and time() < deadline:
+            sleep(0.01)  # Touched by the server thread once the body is sent
+
+    def test_variant_evicted_with_original(self):
+        for name in ("photo.jpg", "photo.jpg.preview.jpg"):
+            with open(os.path.join(self.media_dir, name), 'wb') as f:
+                f.write(name.encode())
+        retention = MediaRetention({'media_dir': self.media_dir, 'config_dir': tempfile.mkdtemp(), 'media': {}})
+        self.tearDown()
+        self.serve(retention)
+
+        response, body = self.request('GET', '/photo.jpg')
+        self.assertEqual(body, b"photo.jpg.preview.jpg")
+        self.wait_touched(retention, "photo.jpg.preview.jpg")
+        self.request('GET', '/file.txt')
+        self.wait_touched(retention, "file.txt")
+        self.assertEqual(list(retention.files), ["photo.jpg", "photo.jpg.preview.jpg", "file.txt"])
+
+        retention.max_bytes = retention.total_bytes - 1  # Just over, only the least recently served has to go
+        self.assertEqual(retention.evict(), 2)
+        response, body = self.request('GET', '/photo.jpg')
+        self.assertEqual(response.status, 410)
+        self.assertFalse(os.path.exists(os.path.join(self.media_dir, "photo.jpg.preview.jpg")))
+
+
+if __name__ == '__main__':
+    unittest.main()
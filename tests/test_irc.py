@@ -0,0 +1,84 @@
+from threading import Event
+import socket
+import unittest
+
+from relaygram import events
+from relaygram.irc import IRCHandler
+from relaygram.queues import SelectableQueue
+
+
+class FakeChannelMap:
+    def __init__(self, routes):
+        self.routes = routes
+
+    def route(self, src):
+        return self.routes.get(src, ())
+
+
+class FakeJournal:
+    def __init__(self):
+        self.acked = []
+
+    def ack(self, name, seq):
+        self.acked.append((name, seq))
+
+
+def make_config(**irc):
+    return {
+        'irc': dict({
+            'message_pattern': "<{nick}> {msg}",
+            'servers': {
+                'test': {'hostname': "irc.test", 'port': 6667, 'nickname': "TGBot", 'channels': ["#chan"]},
+            },
+        }, **irc),
+        'media': {'base_url': "http://localhost/"},
+    }
+
+
+class IRCHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.connecting = Event()
+        self.server, self.bridge = socket.socketpair()
+        self.journal = FakeJournal()
+        self.handler = IRCHandler(FakeChannelMap({("tg", 1): (("irc.test", "#chan"),)}), make_config(max_backlog=20),
+                                  SelectableQueue(), [], self.journal, open_socket=self.open_socket)
+        self.handler.thread.daemon = True
+
+    def tearDown(self):
+        self.connecting.set()
+        self.server.close()
+
+    def open_socket(self, address, timeout=None):
+        self.connecting.wait()  # Still connecting until the test lets it
+        return self.bridge
+
+    def queue_messages(self, count):
+        for seq in range(count):
+            self.handler.my_queue.put_nowait(events.Message(src=("tg", 1), user="tguser", msg="hello")._replace(seq=seq))
+
+    def test_event_before_connected_is_held(self):
+        # Journal backlog is replayed before the server has finished connecting
+        self.queue_messages(10)
+        self.handler.process_queue()
+
+        self.assertEqual(self.journal.acked, [])
+        self.assertEqual(self.handler.irc_senders["irc.test"].backlog(), 10)
+        self.assertIn("#chan", self.handler.irc_senders["irc.test"].held)
+
+
+    def test_backlog_does_not_hold_up_logging_on(self):
+        # Lines are waiting on a server that hasn't connected, it must still get to log on
+        self.queue_messages(10)
+        self.handler.run()
+        self.connecting.set()
+
+        self.server.settimeout(5)
+        received = b""
+        while b"NICK TGBot" not in received:
+            data = self.server.recv(4096)
+            self.assertTrue(data, "Connection closed before NICK")
+            received += data
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+import unittest
+
+from relaygram.irc_sender import HIGH, LOW, IRCSender
+
+
+class FakeConnection:
+    def __init__(self):
+        self.sent = []
+
+    def is_connected(self):
+        return True
+
+    def privmsg(self, channel, line):
+        self.sent.append((channel, line))
+
+
+class IRCSenderTest(unittest.TestCase):
+    def test_full_channel_drops_notices_first(self):
+        sender = IRCSender(FakeConnection(), max_backlog=3)
+        sent = []
+        sender.queue("#full", ["message 1"], on_sent=lambda: sent.append("message 1"))
+        sender.queue("#full", ["join"], on_sent=lambda: sent.append("join"), priority=LOW)
+        sender.queue("#full", ["message 2a", "message 2b"])  # Makes room by dropping the notice
+        sender.queue("#full", ["part"], on_sent=lambda: sent.append("part"), priority=LOW)  # Nothing to drop but itself
+        sender.queue("#full", ["message 3"])  # Then the oldest message goes
+        sender.queue("#other", ["elsewhere 1", "elsewhere 2", "elsewhere 3"])  # Unaffected by the full channel
+
+        self.assertEqual(sent, ["join", "part", "message 1"])
+        self.assertEqual(sender.backlog(), 6)
+        sender.pump()
+        self.assertEqual(sender.connection.sent, [("#full", "message 2a"), ("#other", "elsewhere 1"),
+                                                  ("#full", "message 2b"), ("#other", "elsewhere 2")])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+from threading import Event
+from types import SimpleNamespace
+import os
+import tempfile
+import unittest
+
+from relaygram import events
+from relaygram.botapi import BotAPITransport
+from relaygram.journal import Journal
+from relaygram.media import MediaPipeline
+
+
+class MediaPipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.relayed = []
+        self.downloaded = Event()
+        self.config = {'media': {'base_url': "http://media/"}, 'media_dir': tempfile.mkdtemp()}
+        self.journal = Journal(os.path.join(self.config['media_dir'], "journal"), fsync=False).run()
+        self.pipeline = MediaPipeline(None, self.config, SimpleNamespace(retention=None), self.relayed.append, None,
+                                      self.journal)
+        self.pipeline.fetch = lambda media: self.downloaded.wait(5) and "file.jpg"
+
+    def tearDown(self):
+        self.downloaded.set()
+        self.pipeline.executor.shutdown()
+
+    @staticmethod
+    def message(chat_id, text):
+        return events.Message(src=("tg", chat_id), user="tguser", msg=text)._replace(ts=1.0)
+
+    def test_restart_resumes_held_events(self):
+        self.pipeline.submit(1, SimpleNamespace(file_id="photo", file_size=1000), self.message(1, None),
+                             "[{mime}] {url} [{file_size}]", file_size="1000.0B")
+        self.pipeline.emit(1, self.message(1, "after the photo"))  # Held behind the download
+        self.pipeline.emit(2, self.message(2, "other chat"))
+        self.journal.sync()
+        self.assertEqual([item.msg for item in self.relayed], ["other chat"])
+
+        # Crashed mid-download: a new pipeline picks up from the journal alone
+        relayed = []
+        journal = Journal(self.journal.filename, fsync=False).run()
+        pipeline = MediaPipeline(None, self.config, SimpleNamespace(retention=None), relayed.append, None, journal)
+        pipeline.fetch = lambda media: "{}.jpg".format(media.file_id)
+        pipeline.resume()
+        pipeline.executor.shutdown()
+        self.assertEqual([(item.src, item.msg) for item in relayed],
+                         [(("tg", 1), "[image/jpeg] http://media/photo.jpg [1000.0B]"), (("tg", 1), "after the photo")])
+        self.assertEqual(journal.holds(), [])
+
+    def test_repeated_file_skips_download(self):
+        transport = BotAPITransport({'telegram': {}, 'media': {}})
+        transport.received('getUpdates', [{'update_id': 1, 'message': {'message_id': 1, 'photo': [
+            {'file_id': "small", 'file_unique_id': "u-small", 'width': 90, 'height': 90},
+            {'file_id': "big", 'file_unique_id': "u-big", 'width': 1280, 'height': 1280},
+        ]}}])
+        store = SimpleNamespace(retention=None, lookup={"u-big": "stored.jpg"}.get)
+        config = {'media': {}, 'media_dir': tempfile.mkdtemp()}
+        pipeline = MediaPipeline(None, config, store, self.relayed.append, transport)  # No bot, it can't download
+
+        self.assertEqual(pipeline.fetch(SimpleNamespace(file_id="big", file_size=1000)), "stored.jpg")
+        pipeline.executor.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
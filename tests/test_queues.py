@@ -0,0 +1,27 @@
+from collections import deque
+import unittest
+
+from relaygram import events
+from relaygram.queues import DropPolicy
+
+
+class DropPolicyTest(unittest.TestCase):
+    @staticmethod
+    def fill(policy):
+        items = deque()
+        for item in (events.Message(src=("tg", 1), user="tguser", msg="one"),
+                     events.Message(src=("tg", 1), user="tguser", msg="two"),
+                     events.Topic(src=("tg", 1), user="tguser", msg="topic")):
+            policy.admit(items, item)
+        return [item.msg for item in items]
+
+    def test_defaults_without_policies(self):
+        self.assertEqual(self.fill(DropPolicy("test", "test", 2)), ["one", "two"])
+
+    def test_unlisted_types_are_kept(self):
+        # Topic isn't listed, so it can't be dropped as a newcomer and the oldest message goes instead
+        self.assertEqual(self.fill(DropPolicy("test", "test", 2, {'Join': 'drop'})), ["two", "topic"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import os
+import tempfile
+import time
+import unittest
+
+from relaygram.recorder import IRC_LINE, Recorder, read_recording
+
+
+class RecorderTest(unittest.TestCase):
+    def setUp(self):
+        self.filename = os.path.join(tempfile.mkdtemp(), "traffic.gz")
+        self.recorder = Recorder(self.filename)
+        self.recorder.FLUSH_INTERVAL = 0.05
+
+    def tearDown(self):
+        self.recorder.close()
+
+    def test_last_record_is_flushed_without_more_traffic(self):
+        self.recorder.write(IRC_LINE, 1.0, "irc.test", ":nick PRIVMSG #chan :hello")
+        time.sleep(0.5)
+
+        self.assertEqual(list(read_recording(self.filename)), [[IRC_LINE, 1.0, "irc.test", ":nick PRIVMSG #chan :hello"]])
+
+    def test_write_after_close_is_ignored(self):
+        self.recorder.write(IRC_LINE, 1.0, "irc.test", "first")
+        self.recorder.close()
+        self.recorder.write(IRC_LINE, 2.0, "irc.test", "second")
+
+        self.assertEqual([record[3] for record in read_recording(self.filename)], ["first"])
+
+
+if __name__ == '__main__':
+    unittest.main()
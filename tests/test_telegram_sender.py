@@ -0,0 +1,46 @@
+from time import monotonic
+import unittest
+
+from relaygram.telegram_sender import HIGH, LOW, TelegramSender
+
+
+def make_sender(**telegram):
+    return TelegramSender(None, {'telegram': telegram})
+
+
+class TelegramSenderTest(unittest.TestCase):
+    def test_paused_chat_is_not_ready(self):
+        sender = make_sender()
+        for i in range(3):
+            sender.queue(1, "paused {}".format(i))
+            sender.queue(2, "active {}".format(i))
+        sender.blocked_until[1] = monotonic() + 60  # As after a 429
+
+        self.assertEqual(sender.backlog(), 6)
+        self.assertEqual(sender.ready(), 3)
+
+    def test_chat_over_budget_is_not_ready(self):
+        sender = make_sender(burst_per_chat=1)
+        sender.queue(1, "hello")
+        sender.bucket(1).consume()
+
+        self.assertEqual(sender.ready(), 0)
+
+    def test_full_chat_drops_notices_first(self):
+        sender = make_sender(max_backlog=3)
+        sent = []
+        sender.queue(1, "message 1", HIGH, on_sent=lambda: sent.append("message 1"))
+        sender.queue(1, "join", LOW, on_sent=lambda: sent.append("join"))
+        sender.queue(1, "message 2", HIGH)
+        sender.queue(1, "message 3", HIGH)  # Makes room by dropping the notice
+        sender.queue(1, "part", LOW, on_sent=lambda: sent.append("part"))  # Nothing left to drop but itself
+        sender.queue(1, "message 4", HIGH)  # Then the oldest message goes
+
+        high, low = sender.chats[1]
+        self.assertEqual([text for text, _, _ in high], ["message 2", "message 3", "message 4"])
+        self.assertEqual(list(low), [])
+        self.assertEqual(sent, ["join", "part", "message 1"])
+
+
+if __name__ == '__main__':
+    unittest.main()